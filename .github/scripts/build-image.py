@@ -20,6 +20,9 @@ def process_args():
     parser.add_argument(dest="distro_name", type=str, help="Distro name")
     parser.add_argument(dest="distro_version", type=str, help="Distro version")
     parser.add_argument(dest="de_name", type=str, help="DE name")
+    parser.add_argument("--download-cache", dest="download_cache", help="Persistent download cache dir")
+    parser.add_argument("--package-cache", dest="package_cache", help="Persistent package cache dir")
+    parser.add_argument("--layer-cache", dest="layer_cache", help="Persistent base layer cache dir")
     return parser.parse_args()
 
 
@@ -31,7 +34,20 @@ if __name__ == "__main__":
     build_args.local_path = None
     build_args.dev_build = False
     build_args.no_shrink = False
+    build_args.fast_io = False
+    build_args.trace = False
     build_args.image_size = [10]
+    build_args.download_cache = args.download_cache
+    build_args.download_cache_size = 20
+    build_args.package_cache = args.package_cache
+    build_args.package_cache_age = 30
+    build_args.package_cache_size = 20
+    build_args.metadata_cache_age = 6
+    build_args.layer_cache = args.layer_cache
+    build_args.layer_cache_age = 24
+    build_args.download_connections = 8
+    build_args.stream_rootfs = False
+    build_args.decompress_threads = 0
     testing_dict = {
         "distro_name": args.distro_name,
         "distro_version": args.distro_version,
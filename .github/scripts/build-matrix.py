@@ -0,0 +1,146 @@
+# This script is purely for automatic purposes, it is not meant to be used by end users.
+# Builds multiple distro/version/de combinations on one host and writes the same results files as build-image.py.
+# The first build of each distro version downloads the rootfs, fills the package cache and saves the base layer.
+# The other desktop environments of that version are then built in parallel on top of the cached base layer.
+# Every build runs build-image.py in its own mount namespace with private /mnt/depthboot and /tmp/depthboot-build
+# dirs, and in its own working directory for depthboot.img.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import traceback
+from pathlib import Path
+from threading import Semaphore, Thread
+
+
+def print_header(message: str) -> None:
+    print("\033[95m" + message + "\033[0m", flush=True)
+
+
+def print_error(message: str) -> None:
+    print("\033[91m" + message + "\033[0m", flush=True)
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest="builds", nargs="+", help="Builds as distro:version:de, i.e. ubuntu:22.04:kde")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=2,
+                        help="Maximum amount of builds running at the same time (default: 2)")
+    parser.add_argument("--cache-dir", dest="cache_dir", default="/var/cache/depthboot",
+                        help="Dir for the download, package and base layer caches (default: /var/cache/depthboot)")
+    parser.add_argument("--work-dir", dest="work_dir", default="/tmp/depthboot-matrix",
+                        help="Dir for the images and temporary files of the builds (default: /tmp/depthboot-matrix)")
+    parser.add_argument("--output-dir", dest="output_dir", default=".",
+                        help="Results are written to <output dir>/results_<distro>_<version>_<de>/ (default: .)")
+    return parser.parse_args()
+
+
+# Run a single build and return the image size from its results file, 0 if the build failed.
+# Only builds that run alone for their distro version may use the package cache, as package managers in different
+# chroots would otherwise write the same cache files at the same time.
+def run_build(distro_name: str, distro_version: str, de_name: str, fill_caches: bool) -> float:
+    build_name = f"{distro_name}_{distro_version}_{de_name}"
+    build_dir = Path(f"{args.work_dir}/{build_name}")
+    results_dir = Path(f"{args.output_dir}/results_{build_name}")
+    with job_slots:
+        print_header(f"Starting {distro_name} + {distro_version} + {de_name}")
+        try:
+            image_size = build_image(distro_name, distro_version, de_name, fill_caches, build_dir, results_dir)
+        except Exception:
+            # i.e. the namespace or the build dir could not be set up -> record the build as failed, instead of only
+            # losing the thread
+            image_size = 0
+            try:
+                results_dir.mkdir(parents=True, exist_ok=True)
+                with open(results_dir / "build.log", "a") as log:
+                    log.write(traceback.format_exc())
+                (results_dir / f"{build_name}_results.txt").write_text("0")
+            except OSError:
+                traceback.print_exc()
+        # images are only built to measure their size
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    if image_size == 0:
+        failed_builds.append(build_name)
+        print_error(f"Failed to build {distro_name} + {distro_version} + {de_name}, log: {results_dir}/build.log")
+    else:
+        print_header(f"Finished {distro_name} + {distro_version} + {de_name}: {image_size}GB")
+    return image_size
+
+
+# Run build-image.py in its own mount namespace and copy its log and results file into the results dir
+def build_image(distro_name: str, distro_version: str, de_name: str, fill_caches: bool, build_dir: Path,
+                results_dir: Path) -> float:
+    build_name = f"{distro_name}_{distro_version}_{de_name}"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    for sub_dir in ["mnt", "tmp", "work"]:
+        (build_dir / sub_dir).mkdir(parents=True)
+    # the builder uses paths relative to its working dir -> link the builder sources into it
+    for entry in repo_dir.iterdir():
+        if entry.name not in ["depthboot.img", "depthboot-report.json", "depthboot-trace.json"] and \
+                not entry.name.endswith("_results.txt"):
+            os.symlink(entry, build_dir / "work" / entry.name)
+
+    cache_args = f"--layer-cache {args.cache_dir}/layers"
+    if fill_caches:
+        cache_args += f" --download-cache {args.cache_dir}/downloads --package-cache {args.cache_dir}/packages"
+    command = (f"mount --bind {build_dir}/mnt /mnt/depthboot && "
+               f"mount --bind {build_dir}/tmp /tmp/depthboot-build && "
+               f"exec python3 {script_dir}/build-image.py {distro_name} {distro_version} {de_name} {cache_args}")
+    with open(build_dir / "build.log", "w") as log:
+        subprocess.run(["unshare", "--mount", "--propagation", "private", "sh", "-c", command],
+                       cwd=build_dir / "work", env=dict(os.environ, PYTHONPATH=repo_dir.as_posix()),
+                       stdout=log, stderr=subprocess.STDOUT)
+
+    results_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copy(build_dir / "build.log", results_dir / "build.log")
+    try:
+        shutil.copy(build_dir / "work" / f"{build_name}_results.txt", results_dir)
+        return float((results_dir / f"{build_name}_results.txt").read_text())
+    except (FileNotFoundError, ValueError):
+        (results_dir / f"{build_name}_results.txt").write_text("0")
+        return 0
+
+
+# Build all desktop environments of a distro version, the first one creates the shared base layer
+def build_distro_version(distro_name: str, distro_version: str, de_names: list) -> None:
+    if run_build(distro_name, distro_version, de_names[0], fill_caches=True) == 0:
+        # the base layer might be missing -> build the rest one by one, so that only one of them creates it
+        for de_name in de_names[1:]:
+            run_build(distro_name, distro_version, de_name, fill_caches=True)
+        return
+    threads = [Thread(target=run_build, args=(distro_name, distro_version, de_name, False)) for de_name in
+               de_names[1:]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    args = process_args()
+    repo_dir = Path.cwd()
+    script_dir = Path(__file__).resolve().parent
+    job_slots = Semaphore(args.jobs)
+    failed_builds = []  # names of all failed builds, appended to by the build threads
+    Path("/mnt/depthboot").mkdir(parents=True, exist_ok=True)
+    Path("/tmp/depthboot-build").mkdir(parents=True, exist_ok=True)
+
+    # group builds by distro version, keeping the order of the arguments
+    distro_versions = {}
+    for build in args.builds:
+        distro_name, distro_version, de_name = build.split(":")
+        distro_versions.setdefault((distro_name, distro_version), []).append(de_name)
+
+    version_threads = [Thread(target=build_distro_version, args=(distro_name, distro_version, de_names)) for
+                       (distro_name, distro_version), de_names in distro_versions.items()]
+    for version_thread in version_threads:
+        version_thread.start()
+    for version_thread in version_threads:
+        version_thread.join()
+
+    if failed_builds:
+        print_error(f"{len(failed_builds)} of {len(args.builds)} builds failed: {', '.join(failed_builds)}")
+        sys.exit(1)
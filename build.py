@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 import atexit
+import errno
+import glob
+import http.client
 import json
 import os
 from typing import Tuple
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 
+from build_report import build_phase, phase_trace_events, print_build_report, write_build_report
 from functions import *
+# replacements for helpers of the vendored functions.py, have to be imported after it
+from commands import bash, chroot, close_chroot, print_slowest_commands, run_phases, set_command_trace, \
+    write_command_trace
+from downloads import download_and_extract, download_file, download_files, get_remote_file_version, \
+    set_download_cache, set_download_connections, url_exists
+from extract import extract_file, set_decompress_threads, zstd_available
+from fileops import cpdir, cpfile, rmdir
+from layer_cache import base_layer_available, base_layer_name, restore_base_layer, save_base_layer, set_layer_cache
+from package_cache import mount_package_cache, set_package_cache, umount_package_cache
 
 img_mnt = ""  # empty to avoid variable not defined error in exit_handler
+rootfs_part = ""  # rootfs partition of the image/device
+fast_io = False  # trade durability for speed until the end of the build
+pop_os_release = "https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/"
+rootfs_checksums = {}  # cache for get_rootfs_parts_checksums, by checksums url
 
 
 # the exit handler with user messages is in main.py
@@ -18,6 +35,8 @@ def exit_handler():
     if exc_type != KeyboardInterrupt:
         return
     print_error("Ctrl+C detected. Cleaning machine and exiting...")
+    # stop the chroot shell and any command still running in it
+    close_chroot(kill=True)
     # Kill arch gpg agent if present
     print_status("Killing gpg-agent arch processes if they exist")
     gpg_pids = []
@@ -42,32 +61,148 @@ def exit_handler():
         bash(f"umount -lf {img_mnt}*")  # umount all partitions from usb/sd-card
 
 
+# write the trace of all commands of the build next to the image
+def write_trace() -> None:
+    write_command_trace("depthboot-trace.json", phase_trace_events())
+    print_slowest_commands()
+    print_status(f"Command trace written to {get_full_path('.')}/depthboot-trace.json")
+
+
+# urls of all parts of the distro rootfs archive with the given extension, in order
+def get_rootfs_urls(distro_name: str, distro_version: str, extension: str) -> list:
+    match distro_name:
+        case "arch":
+            return [f"https://geo.mirror.pkgbuild.com/iso/latest/archlinux-bootstrap-x86_64{extension}"]
+        case "ubuntu" | "fedora":
+            return [f"https://github.com/eupnea-linux/{distro_name}-rootfs/releases/latest/download/"
+                    f"{distro_name}-rootfs-{distro_version}{extension}"]
+        case "pop-os":
+            if extension != ".tar.xz":
+                return [f"{pop_os_release}pop-os-rootfs-22.04{extension}"]
+            # the xz archive is too big for GitHub releases and is therefore split into parts: .aa, .ab, ...
+            # The parts are listed in the checksums file. Without one, they are probed one after another.
+            parts_urls = sorted(url for url in get_rootfs_parts_checksums(f"{pop_os_release}pop-os-rootfs-22.04"
+                                                                          ".sha256sums") if ".split." in url)
+            if not parts_urls:
+                for letter in "abcdefghijklmnopqrstuvwxyz":
+                    part_url = f"{pop_os_release}pop-os-rootfs-22.04.split.a{letter}"
+                    if not url_exists(part_url):
+                        break
+                    parts_urls.append(part_url)
+            if not parts_urls:
+                raise FileNotFoundError("No pop-os rootfs parts found in the latest release")
+            return parts_urls
+
+
+# Checksums of all parts of a split rootfs archive, read from a sha256sum formatted file in the same release.
+# Returns a dict of url: sha256, which is empty if no checksums file was published
+def get_rootfs_parts_checksums(checksums_url: str) -> dict:
+    if checksums_url in rootfs_checksums:
+        return rootfs_checksums[checksums_url]
+    release_url = checksums_url[:checksums_url.rfind("/") + 1]
+    checksums = {}
+    try:
+        with urlopen(checksums_url, timeout=60) as response:
+            for line in response.read().decode().splitlines():
+                if line.strip():
+                    checksum, file_name = line.split()
+                    checksums[release_url + file_name.lstrip("*")] = checksum
+    except HTTPError as e:
+        if e.code not in [404, 410]:
+            raise e
+        print_warning("No checksums published for the rootfs parts, only verifying their sizes")
+    rootfs_checksums[checksums_url] = checksums
+    return checksums
+
+
+# Find the fastest to extract rootfs archive that is available. zstd archives are preferred over xz/gz.
+# Returns the urls of all parts of the archive and the name of the complete archive in /tmp/depthboot-build
+def get_rootfs_source(distro_name: str, distro_version: str) -> Tuple[list, str]:
+    fallback_extension = ".tar.gz" if distro_name == "arch" else ".tar.xz"
+    if zstd_available():
+        zstd_urls = get_rootfs_urls(distro_name, distro_version, ".tar.zst")
+        if url_exists(zstd_urls[0]):
+            return zstd_urls, f"{distro_name}-rootfs.tar.zst"
+        print(f"No zstd rootfs found, falling back to {fallback_extension}")
+    return get_rootfs_urls(distro_name, distro_version, fallback_extension), f"{distro_name}-rootfs{fallback_extension}"
+
+
+# Version of the rootfs archive a build extracts, changes when a new "latest" rootfs is released or another local
+# rootfs is used
+def get_rootfs_version(distro_name: str, distro_version: str, local_path: str = None) -> str:
+    if local_path is not None:
+        local_path_posix = local_path if local_path.endswith("/") else f"{local_path}/"
+        for extension in [".tar.zst", ".tar.xz"]:
+            if path_exists(f"{local_path_posix}rootfs{extension}"):
+                rootfs_stat = os.stat(f"{local_path_posix}rootfs{extension}")
+                return f"{local_path_posix}rootfs{extension} {rootfs_stat.st_size} {rootfs_stat.st_mtime_ns}"
+    rootfs_urls, archive_name = get_rootfs_source(distro_name, distro_version)
+    # the published checksums of split archives already identify the parts
+    checksums = rootfs_checksums.get(f"{pop_os_release}pop-os-rootfs-22.04.sha256sums", {})
+    return " ".join(checksums.get(url) or get_remote_file_version(url) for url in rootfs_urls)
+
+
+# path of the downloaded/copied rootfs archive in /tmp/depthboot-build
+def get_rootfs_archive(distro_name: str) -> str:
+    for extension in [".tar.zst", ".tar.xz", ".tar.gz"]:
+        if path_exists(f"/tmp/depthboot-build/{distro_name}-rootfs{extension}"):
+            return f"/tmp/depthboot-build/{distro_name}-rootfs{extension}"
+    raise FileNotFoundError(f"No {distro_name} rootfs archive in /tmp/depthboot-build")
+
+
 # download the distro rootfs
 def download_rootfs(distro_name: str, distro_version: str) -> None:
     try:
+        rootfs_urls, archive_name = get_rootfs_source(distro_name, distro_version)
         match distro_name:
             case "arch":
                 print_status("Downloading latest arch rootfs from geo.mirror.pkgbuild.com")
-                download_file("https://geo.mirror.pkgbuild.com/iso/latest/archlinux-bootstrap-x86_64.tar.gz",
-                              "/tmp/depthboot-build/arch-rootfs.tar.gz")
+                download_file(rootfs_urls[0], f"/tmp/depthboot-build/{archive_name}")
             case "ubuntu" | "fedora":
                 print_status(f"Downloading {distro_name} rootfs, version {distro_version} from eupnea github releases")
-                download_file(f"https://github.com/eupnea-linux/{distro_name}-rootfs/releases/latest/download/"
-                              f"{distro_name}-rootfs-{distro_version}.tar.xz",
-                              f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz")
+                download_file(rootfs_urls[0], f"/tmp/depthboot-build/{archive_name}")
             case "pop-os":
-                print_status("Downloading pop-os rootfs from eupnea github releases")
-                download_file("https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/pop-os-rootfs-"
-                              "22.04.split.aa", "/tmp/depthboot-build/pop-os-rootfs.split.aa")
-                # print_status("Downloading pop-os rootfs from eupnea GitHub releases, part 2/2")
-                # download_file("https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/pop-os-rootfs"
-                #              "-22.04.split.ab", "/tmp/depthboot-build/pop-os-rootfs.split.ab")
-                print_status("Combining split pop-os rootfs, might take a while")
-                bash("cat /tmp/depthboot-build/pop-os-rootfs.split.?? > /tmp/depthboot-build/pop-os-rootfs.tar.xz")
-    except URLError:
+                if ".split." not in rootfs_urls[0]:
+                    print_status("Downloading pop-os rootfs from eupnea github releases")
+                    download_file(rootfs_urls[0], f"/tmp/depthboot-build/{archive_name}")
+                    return
+                print_status(f"Downloading all {len(rootfs_urls)} pop-os rootfs parts from eupnea github releases")
+                checksums = get_rootfs_parts_checksums(f"{pop_os_release}pop-os-rootfs-22.04.sha256sums")
+                # the parts are extracted as one stream later -> no need to combine them
+                download_files([(url, f"/tmp/depthboot-build/pop-os-rootfs.split.{url[-2:]}") for url in rootfs_urls],
+                               checksums)
+    except (URLError, ConnectionError, TimeoutError, http.client.HTTPException):
+        # download_file already retried with backoff, a rerun resumes the partial download
         print_error("Couldn't download rootfs. Check your internet connection and try again. If the error persists, "
                     "create an issue with the distro and version in the name")
         sys.exit(1)
+    except FileNotFoundError as e:  # release without rootfs
+        print_error(f"{e}. Please create an issue with the distro and version in the name")
+        sys.exit(1)
+    except ValueError as e:  # size or checksum mismatch
+        print_error(f"Downloaded rootfs is corrupted: {e}. Please restart the script.")
+        sys.exit(1)
+
+
+# download the distro rootfs and extract it while downloading
+def stream_rootfs(distro_name: str, distro_version: str, dest: str, strip_prefix: str = "") -> None:
+    print_status(f"Downloading and extracting {distro_name} rootfs at the same time")
+    try:
+        rootfs_urls, archive_name = get_rootfs_source(distro_name, distro_version)
+        checksums = {}
+        if ".split." in rootfs_urls[0]:
+            checksums = get_rootfs_parts_checksums(f"{pop_os_release}pop-os-rootfs-22.04.sha256sums")
+        download_and_extract(rootfs_urls, archive_name, dest, strip_prefix, checksums)
+    except (URLError, ConnectionError, TimeoutError, http.client.HTTPException):
+        print_error("Couldn't download rootfs. Check your internet connection and try again. If the error persists, "
+                    "create an issue with the distro and version in the name")
+        sys.exit(1)
+    except FileNotFoundError as e:  # release without rootfs
+        print_error(f"{e}. Please create an issue with the distro and version in the name")
+        sys.exit(1)
+    except ValueError as e:  # size or checksum mismatch, the partially extracted rootfs is overwritten by a rerun
+        print_error(f"Downloaded rootfs is corrupted: {e}. Please restart the script.")
+        sys.exit(1)
 
 
 # Create, mount, partition the img and flash the eupnea kernel
@@ -124,7 +259,9 @@ def partition(write_usb: bool) -> None:
     print_status("Preparing device/image partition")
 
     # Determine rootfs part name
+    global rootfs_part
     rootfs_mnt = f"{img_mnt}3" if write_usb else f"{img_mnt}p3"
+    rootfs_part = rootfs_mnt
     # remove pre-existing partition table from storage device
     bash(f"wipefs -af {img_mnt}")
 
@@ -147,26 +284,43 @@ def partition(write_usb: bool) -> None:
 
     print_status("Formatting rootfs partition")
     # Create rootfs ext4 partition
-    bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
+    if fast_io:
+        # without a journal every write only hits the disk once. The journal is added back by restore_durability
+        bash(f"yes 2>/dev/null | mkfs.ext4 -O ^has_journal {rootfs_mnt}")
+    else:
+        bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
 
     # Mount rootfs partition
-    bash(f"mount {rootfs_mnt} /mnt/depthboot")
+    if fast_io:
+        # do not flush the device cache on every fsync
+        bash(f"mount -o noatime,nobarrier {rootfs_mnt} /mnt/depthboot")
+    else:
+        bash(f"mount {rootfs_mnt} /mnt/depthboot")
 
     print_status("Device/image preparation complete")
 
 
 # extract the rootfs to /mnt/depthboot
-def extract_rootfs(distro_name: str, distro_version: str) -> None:
+# if stream is set, the rootfs is downloaded and extracted at the same time
+def extract_rootfs(distro_name: str, distro_version: str, stream: bool = False) -> None:
     print_status("Extracting rootfs")
     match distro_name:
         case "arch":
             print_status("Extracting arch rootfs")
-            mkdir("/tmp/depthboot-build/arch-rootfs")
-            extract_file("/tmp/depthboot-build/arch-rootfs.tar.gz", "/tmp/depthboot-build/arch-rootfs")
-            cpdir("/tmp/depthboot-build/arch-rootfs/root.x86_64/", "/mnt/depthboot/")
+            # the bootstrap archive has the rootfs in a root.x86_64 dir -> extract only its contents
+            if stream:
+                stream_rootfs(distro_name, distro_version, "/mnt/depthboot", strip_prefix="root.x86_64")
+            else:
+                extract_file(get_rootfs_archive("arch"), "/mnt/depthboot", strip_prefix="root.x86_64")
         case "pop-os" | "ubuntu" | "fedora":
             print_status(f"Extracting {distro_name} rootfs")
-            extract_file(f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz", "/mnt/depthboot")
+            split_parts = sorted(glob.glob(f"/tmp/depthboot-build/{distro_name}-rootfs.split.??"))
+            if stream:
+                stream_rootfs(distro_name, distro_version, "/mnt/depthboot")
+            elif split_parts:
+                extract_file(f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz", "/mnt/depthboot", parts=split_parts)
+            else:
+                extract_file(get_rootfs_archive(distro_name), "/mnt/depthboot")
         case "generic":
             def prompt_user_for_rootfs():
                 while True:
@@ -290,42 +444,13 @@ def extract_rootfs(distro_name: str, distro_version: str) -> None:
 def post_extract(build_options) -> None:
     print_status("Applying distro agnostic configuration")
     if build_options["distro_name"] != "generic":
-        # Create a temporary resolv.conf for internet inside the chroot
-        mkdir("/mnt/depthboot/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didnt run
-        open("/mnt/depthboot/run/systemd/resolve/stub-resolv.conf", "w").close()  # create empty file for mount
-        # Bind mount host resolv.conf to chroot resolv.conf.
-        # If chroot /etc/resolv.conf is a symlink, then it will be resolved to the real file and bind mounted
-        # This is needed for internet inside the chroot
-        bash("mount --bind /etc/resolv.conf /mnt/depthboot/etc/resolv.conf")
-
-        # the following mounts are mostly unneeded, but will produce a lot of warnings if not mounted
-        # even though the resulting image will work as intended and won't have any issues
-        # mounting the full directories results in broken host systems -> only mount what's explicitly needed
-
-        # systemd needs /proc to not throw warnings
-        bash("mount --types proc /proc /mnt/depthboot/proc")
+        mount_chroot()
 
         # pacman needs the /dev/fd to not throw warnings
         # check if link already exists, if not, create it
         if not path_exists("/mnt/depthboot/dev/fd"):
             bash("cd /mnt/depthboot && ln -s /proc/self/fd ./dev/fd")
 
-        # create new /dev/pts for apt to be able to write logs and not throw warnings
-        mkdir("/mnt/depthboot/dev/pts", create_parents=True)
-        bash("mount --types devpts devpts /mnt/depthboot/dev/pts")
-
-        # create depthboot settings file for postinstall scripts to read
-        with open("configs/eupnea.json", "r") as settings_file:
-            settings = json.load(settings_file)
-        settings["distro_name"] = build_options["distro_name"]
-        settings["distro_version"] = build_options["distro_version"]
-        settings["de_name"] = build_options["de_name"]
-        settings["shell"] = build_options["shell"]
-        if build_options["device"] != "image":
-            settings["install_type"] = "direct"
-        with open("/mnt/depthboot/etc/eupnea.json", "w") as settings_file:
-            json.dump(settings, settings_file)
-
         print_status("Fixing screen rotation")
         # Install hwdb file to fix auto rotate being flipped on some devices
         cpfile("configs/hwdb/61-sensor.hwdb", "/mnt/depthboot/etc/udev/hwdb.d/61-sensor.hwdb")
@@ -340,11 +465,56 @@ def post_extract(build_options) -> None:
         # on other distros networkmanager takes care of this
         chroot("systemctl enable systemd-resolved")
 
+
+# Mount the host resolv.conf, /proc and /dev/pts into the chroot
+def mount_chroot() -> None:
+    # Create a temporary resolv.conf for internet inside the chroot
+    mkdir("/mnt/depthboot/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didnt run
+    open("/mnt/depthboot/run/systemd/resolve/stub-resolv.conf", "w").close()  # create empty file for mount
+    # Bind mount host resolv.conf to chroot resolv.conf.
+    # If chroot /etc/resolv.conf is a symlink, then it will be resolved to the real file and bind mounted
+    # This is needed for internet inside the chroot
+    bash("mount --bind /etc/resolv.conf /mnt/depthboot/etc/resolv.conf")
+
+    # the following mounts are mostly unneeded, but will produce a lot of warnings if not mounted
+    # even though the resulting image will work as intended and won't have any issues
+    # mounting the full directories results in broken host systems -> only mount what's explicitly needed
+
+    # systemd needs /proc to not throw warnings
+    bash("mount --types proc /proc /mnt/depthboot/proc")
+
+    # create new /dev/pts for apt to be able to write logs and not throw warnings
+    mkdir("/mnt/depthboot/dev/pts", create_parents=True)
+    bash("mount --types devpts devpts /mnt/depthboot/dev/pts")
+
+
+# Undo mount_chroot, to be able to copy the rootfs without any host files
+def umount_chroot() -> None:
+    close_chroot()  # the chroot shell keeps /proc busy
+    for mount_point in ["/mnt/depthboot/dev/pts", "/mnt/depthboot/proc", "/mnt/depthboot/etc/resolv.conf"]:
+        bash(f"umount {mount_point}")
+
+
+# Configure the settings that are different for every build: the depthboot settings file, the user and the timezone
+def configure_build(build_options) -> None:
+    if build_options["distro_name"] != "generic":
+        # create depthboot settings file for postinstall scripts to read
+        with open("configs/eupnea.json", "r") as settings_file:
+            settings = json.load(settings_file)
+        settings["distro_name"] = build_options["distro_name"]
+        settings["distro_version"] = build_options["distro_version"]
+        settings["de_name"] = build_options["de_name"]
+        settings["shell"] = build_options["shell"]
+        if build_options["device"] != "image":
+            settings["install_type"] = "direct"
+        with open("/mnt/depthboot/etc/eupnea.json", "w") as settings_file:
+            json.dump(settings, settings_file)
+
     print_status("Configuring user")
     username = build_options["username"]  # quotes interfere with functions below
     chroot(f"useradd --create-home --shell /bin/{build_options['shell']} {username}")
     password = build_options["password"]  # quotes interfere with functions below
-    chroot(f"echo '{username}:{password}' | chpasswd")
+    chroot(f"echo '{username}:{password}' | chpasswd", sensitive=True)
     with open("/mnt/depthboot/etc/group", "r") as group_file:
         group_lines = group_file.readlines()
     for line in group_lines:
@@ -376,13 +546,18 @@ def post_config(distro_name: str, verbose_kernel: bool, kernel_type: str, is_usb
 
     # if local path option was used, extract modules and headers to the rootfs
     # check if at least kernel image and modules exist as otherwise the kernel won't boot
-    if path_exists(f"{local_path}modules.tar.xz") and path_exists(f"{local_path}bzImage"):
+    # zstd archives are preferred over xz
+    modules_archive = next((f"{local_path}modules{extension}" for extension in [".tar.zst", ".tar.xz"]
+                            if path_exists(f"{local_path}modules{extension}")), "")
+    headers_archive = next((f"{local_path}headers{extension}" for extension in [".tar.zst", ".tar.xz"]
+                            if path_exists(f"{local_path}headers{extension}")), "")
+    if modules_archive and path_exists(f"{local_path}bzImage"):
         print_status("Extracting kernel modules from local path to rootfs")
-        extract_file(f"{local_path}modules.tar.xz", "/mnt/depthboot/lib/modules/")
+        extract_file(modules_archive, "/mnt/depthboot/lib/modules/")
         kernel_path = f"{local_path}bzImage"  # set kernel path to local path
-        if path_exists(f"{local_path}headers.tar.xz"):  # kernel headers are not required to boot
+        if headers_archive:  # kernel headers are not required to boot
             print_status("Extracting kernel headers from local path")
-            extract_file(f"{local_path}headers.tar.xz", "/mnt/depthboot/usr/src/")
+            extract_file(headers_archive, "/mnt/depthboot/usr/src/")
     else:
         kernel_path = f"/mnt/depthboot/boot/vmlinuz-eupnea-{kernel_type}"
 
@@ -447,6 +622,8 @@ def post_config(distro_name: str, verbose_kernel: bool, kernel_type: str, is_usb
         cpfile("/mnt/depthboot/usr/sbin/fixfiles.bak", "/mnt/depthboot/usr/sbin/fixfiles")
         rmfile("/mnt/depthboot/usr/sbin/fixfiles.bak")
 
+    # the chroot shell would keep the image busy
+    close_chroot()
     # Unmount everything
     with contextlib.suppress(subprocess.CalledProcessError):  # will throw errors for unmounted paths
         bash("umount -lR /mnt/depthboot")  # recursive unmount
@@ -461,12 +638,74 @@ def post_config(distro_name: str, verbose_kernel: bool, kernel_type: str, is_usb
     rmdir("/mnt/depthboot/lost+found")
     rmdir("/mnt/depthboot/dev")
 
+    if fast_io:
+        restore_durability()
+
+
+# Stop package managers from syncing every installed file to the disk, as everything is synced once at the end
+# dpkg has an option for it. pacman does not sync single files and rpm doesn't by default (_flush_io 0).
+def suppress_fsync(distro_name: str, suppress: bool) -> None:
+    if not fast_io:
+        return
+    match distro_name:
+        case "ubuntu" | "pop-os":
+            config_file = "/mnt/depthboot/etc/dpkg/dpkg.cfg.d/depthboot-unsafe-io"
+            config = "force-unsafe-io\n"
+        case _:
+            return
+    if suppress:
+        mkdir(config_file[:config_file.rfind("/")], create_parents=True)
+        with open(config_file, "w") as file:
+            file.write(config)
+    else:
+        rmfile(config_file)
+
+
+# Undo the fast io settings: write everything to the disk, add the filesystem journal back and check the filesystem.
+def restore_durability() -> None:
+    print_status("Syncing rootfs and restoring filesystem journal")
+    bash("sync")
+    # post_config unmounts lazily, i.e. the filesystem might still be mounted somewhere or busy
+    if bash(f"findmnt -n -o TARGET --source {rootfs_part} || true"):
+        bash(f"umount --all-targets {rootfs_part}")
+    # the kernel keeps a detached filesystem open until its last user exits -> wait for exclusive access to the device
+    for _ in range(60):
+        try:
+            os.close(os.open(rootfs_part, os.O_RDONLY | os.O_EXCL))
+            break
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            sleep(1)
+    else:
+        print_error(f"{rootfs_part} is still in use, can't restore the filesystem journal")
+        sys.exit(1)
+    bash(f"tune2fs -O has_journal {rootfs_part}")
+    try:
+        bash(f"e2fsck -fp {rootfs_part}")
+    except subprocess.CalledProcessError as e:
+        if e.returncode != 1:  # 1 = errors were corrected
+            raise
+    bash("sync")
+
 
 # the main build function
 def start_build(build_options: dict, args: argparse.Namespace) -> None:
     if args.verbose:
         print(args)
     set_verbose(args.verbose)
+    if args.trace:
+        set_command_trace(True)
+        atexit.register(write_trace)  # also write the trace if the build fails
+    global fast_io
+    fast_io = args.fast_io
+    set_download_connections(args.download_connections)
+    set_decompress_threads(args.decompress_threads)
+    if args.download_cache:
+        set_download_cache(args.download_cache, args.download_cache_size)
+    if args.package_cache:
+        set_package_cache(args.package_cache, args.package_cache_age, args.package_cache_size,
+                          args.metadata_cache_age)
     atexit.register(exit_handler)
     print_status("Starting build")
 
@@ -474,31 +713,62 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
     mkdir("/tmp/depthboot-build", create_parents=True)
     mkdir("/mnt/depthboot", create_parents=True)
 
+    # builds of the same distro, version and kernel share everything up to the desktop environment
+    layer_name = ""
+    if args.layer_cache and build_options["distro_name"] != "generic":
+        set_layer_cache(args.layer_cache, args.layer_cache_age)
+        try:
+            rootfs_version = get_rootfs_version(build_options["distro_name"], build_options["distro_version"],
+                                                args.local_path)
+            layer_name = base_layer_name(build_options["distro_name"], build_options["distro_version"],
+                                         build_options["kernel_type"], rootfs_version)
+        except (URLError, ConnectionError, TimeoutError, http.client.HTTPException, FileNotFoundError):
+            print_warning("Couldn't check the version of the rootfs, not using the base layer cache")
+    restore_layer = layer_name != "" and base_layer_available(layer_name)
+
     local_path_posix = ""
-    if args.local_path is None:  # default
-        download_rootfs(build_options["distro_name"], build_options["distro_version"])
+    download = False  # the rootfs is downloaded while the image/device is prepared
+    # the rootfs can only be streamed once the image/device is ready
+    stream = args.stream_rootfs and args.local_path is None and build_options["distro_name"] != "generic"
+    if restore_layer:
+        print_status("Base layer is cached, skipping rootfs download")
+    elif stream:
+        print_status("Rootfs will be downloaded while extracting")
+    elif args.local_path is None:  # default
+        download = True
     else:  # if local path is specified, copy files from it, instead of downloading from the internet
         print_status("Copying local files to /tmp/depthboot-build")
         # clean local path string
         local_path_posix = args.local_path if args.local_path.endswith("/") else f"{args.local_path}/"
 
-        # copy distro rootfs
-        try:
+        # copy distro rootfs, zstd archives are preferred over xz
+        if path_exists(f"{local_path_posix}rootfs.tar.zst"):
+            cpfile(f"{local_path_posix}rootfs.tar.zst",
+                   f"/tmp/depthboot-build/{build_options['distro_name']}-rootfs.tar.zst")
+        elif path_exists(f"{local_path_posix}rootfs.tar.xz"):
             cpfile(f"{local_path_posix}rootfs.tar.xz",
                    f"/tmp/depthboot-build/{build_options['distro_name']}-rootfs.tar.xz")
-        except FileNotFoundError:
-            print_warning(f"File 'rootfs.tar.xz' not found in {args.local_path}. Attempting to download rootfs")
-            download_rootfs(build_options["distro_name"], build_options["distro_version"])
+        else:
+            print_warning(f"File 'rootfs.tar.zst' or 'rootfs.tar.xz' not found in {args.local_path}. Attempting to "
+                          "download rootfs")
+            download = True
 
     # Setup device
-    if build_options["device"] == "image":
-        is_usb = prepare_img(args.image_size[0])
-    else:
-        is_usb = prepare_usb_sd(build_options["device"])
-    # Extract rootfs and configure distro agnostic settings
-    extract_rootfs(build_options["distro_name"], build_options["distro_version"])
-    post_extract(build_options)
+    def prepare_device() -> bool:
+        with build_phase("prepare_device"):
+            if build_options["device"] == "image":
+                return prepare_img(args.image_size[0])
+            return prepare_usb_sd(build_options["device"])
+
+    def download_phase() -> None:
+        with build_phase("download"):
+            download_rootfs(build_options["distro_name"], build_options["distro_version"])
 
+    if download:
+        # creating and formatting the image/device does not depend on the rootfs -> do both at the same time
+        is_usb = run_phases(prepare_device, download_phase)[0]
+    else:
+        is_usb = prepare_device()
     match build_options["distro_name"]:
         case "ubuntu":
             import distro.ubuntu as distro
@@ -510,12 +780,49 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
             import distro.pop_os as distro
         case _:
             print_status("Generic install, skipping distro specific configuration")
-    with contextlib.suppress(UnboundLocalError):
-        distro.config(build_options["de_name"], build_options["distro_version"], args.verbose,
-                      build_options["kernel_type"], build_options["shell"])
 
-    post_config(build_options["distro_name"], args.verbose_kernel, build_options["kernel_type"], is_usb,
-                local_path_posix)
+    if restore_layer:
+        with build_phase("restore_base_layer"):
+            restore_base_layer(layer_name)
+            mount_chroot()
+    else:
+        # Extract rootfs and configure distro agnostic settings
+        with build_phase("extract_rootfs"):
+            extract_rootfs(build_options["distro_name"], build_options["distro_version"], stream)
+        with build_phase("post_extract"):
+            post_extract(build_options)
+        if layer_name:
+            with build_phase("base_layer"):
+                print_status("Installing base system")
+                mount_package_cache(build_options["distro_name"], build_options["distro_version"])
+                suppress_fsync(build_options["distro_name"], True)
+                distro.config_base(build_options["distro_version"], args.verbose, build_options["kernel_type"]).apply()
+                suppress_fsync(build_options["distro_name"], False)
+                umount_package_cache()
+                # the layer should not contain any host files
+                umount_chroot()
+                save_base_layer(layer_name)
+                mount_chroot()
+
+    with build_phase("distro_config"):
+        configure_build(build_options)
+        mount_package_cache(build_options["distro_name"], build_options["distro_version"])
+        suppress_fsync(build_options["distro_name"], True)
+        if build_options["distro_name"] != "generic":
+            if layer_name:  # the base system is already installed
+                transaction = distro.config_restored_base(build_options["distro_version"], args.verbose)
+            else:
+                transaction = distro.config_base(build_options["distro_version"], args.verbose,
+                                                 build_options["kernel_type"])
+            distro.config_de(transaction, build_options["de_name"], build_options["distro_version"],
+                             build_options["shell"])
+        suppress_fsync(build_options["distro_name"], False)
+        # cached packages should not end up in the image
+        umount_package_cache()
+
+    with build_phase("post_config"):
+        post_config(build_options["distro_name"], args.verbose_kernel, build_options["kernel_type"], is_usb,
+                    local_path_posix)
 
     print_status("Unmounting image/device")
 
@@ -523,10 +830,12 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
 
     # unmount image/device completely from system
     # on crostini umount fails for some reason
+    # /dev/loopX* would also match the loop devices of other builds running at the same time
     with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lR {img_mnt}p*")  # umount all partitions from image
-    with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lR {img_mnt}*")  # umount all partitions from usb/sd-card
+        if build_options["device"] == "image":
+            bash(f"umount -lR {img_mnt}p*")  # umount all partitions from image
+        else:
+            bash(f"umount -lR {img_mnt}*")  # umount all partitions from usb/sd-card
 
     # unmount any isos/images from /tmp/depthboot-build
     with contextlib.suppress(subprocess.CalledProcessError):
@@ -549,15 +858,16 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
         if product_name != "crosvm" and not args.no_shrink:
             # Shrink image to actual size
             print_status("Shrinking image")
-            bash(f"e2fsck -fpv {img_mnt}p3")  # Force check filesystem for errors
-            bash(f"resize2fs -f -M {img_mnt}p3")
-            block_count = int(bash(f"dumpe2fs -h {img_mnt}p3 | grep 'Block count:'")[12:].split()[0])
-            actual_fs_in_bytes = block_count * 4096
-            # the kernel part is always the same size -> sector amount: 131072 * 512 => 67108864 bytes
-            # There are 2 kernel partitions -> 67108864 bytes * 2 = 134217728 bytes
-            actual_fs_in_bytes += 134217728
-            actual_fs_in_bytes += 20971520  # add 20mb for linux to be able to boot properly
-            bash(f"truncate --size={actual_fs_in_bytes} ./depthboot.img")
+            with build_phase("shrink"):
+                bash(f"e2fsck -fpv {img_mnt}p3")  # Force check filesystem for errors
+                bash(f"resize2fs -f -M {img_mnt}p3")
+                block_count = int(bash(f"dumpe2fs -h {img_mnt}p3 | grep 'Block count:'")[12:].split()[0])
+                actual_fs_in_bytes = block_count * 4096
+                # the kernel part is always the same size -> sector amount: 131072 * 512 => 67108864 bytes
+                # There are 2 kernel partitions -> 67108864 bytes * 2 = 134217728 bytes
+                actual_fs_in_bytes += 134217728
+                actual_fs_in_bytes += 20971520  # add 20mb for linux to be able to boot properly
+                bash(f"truncate --size={actual_fs_in_bytes} ./depthboot.img")
         if product_name == "crosvm":
             # rename the image to .bin for the chromeos recovery utility to be able to flash it
             bash("mv ./depthboot.img ./depthboot.bin")
@@ -568,6 +878,9 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
     else:
         print_header(f"USB/SD-card is ready to boot {build_options['distro_name'].capitalize()}")
         print_header("It is safe to remove the USB-drive/SD-card now.")
+    print_build_report()
+    write_build_report("depthboot-report.json", build_options)
+    print_status(f"Build report written to {get_full_path('.')}/depthboot-report.json")
     print_header("Please report any bugs/issues on GitHub or on the Discord server.")
 
 
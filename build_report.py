@@ -0,0 +1,128 @@
+# Wall time and resource usage of the build phases, written to depthboot-report.json next to the image and printed as
+# a table at the end of the build.
+# All counters are process wide and include child processes, the running chroot shell included. Phases that run at the
+# same time (i.e. the rootfs download and the device preparation) therefore include each other's usage. Network bytes
+# are counted on all interfaces of the host.
+import json
+import os
+import resource
+from time import time
+from typing import Tuple
+
+from functions import *
+from commands import get_trace_phase, set_trace_phase
+
+report_phases = []  # finished phases, in the order they ended
+
+
+@contextlib.contextmanager
+def build_phase(name: str):
+    start = _snapshot()
+    completed = False
+    previous_phase = get_trace_phase()
+    set_trace_phase(name)
+    try:
+        yield
+        completed = True
+    finally:
+        set_trace_phase(previous_phase)
+        end = _snapshot()
+        report_phases.append({
+            "name": name,
+            "completed": completed,
+            "start": start["time"],
+            "wall_seconds": round(end["time"] - start["time"], 3),
+            "cpu_seconds": round(end["cpu"] - start["cpu"], 3),
+            # the kernel only tracks the peak of the whole process -> peak since the build started
+            "peak_rss_mb": round(end["peak_rss"] / 1024, 1),
+            "read_bytes": end["read_bytes"] - start["read_bytes"],
+            "written_bytes": end["written_bytes"] - start["written_bytes"],
+            "network_received_bytes": end["network_received"] - start["network_received"],
+            "network_sent_bytes": end["network_sent"] - start["network_sent"]
+        })
+
+
+def write_build_report(path: str, build_options: dict) -> None:
+    """
+    Write the recorded phases as JSON.
+
+    :param path: A string representing the full path to the report file.
+    :param build_options: The build options. The distro, version, desktop environment and kernel are added to the
+                          report.
+    :return: None
+    """
+    report = {
+        "distro_name": build_options["distro_name"],
+        "distro_version": build_options["distro_version"],
+        "de_name": build_options["de_name"],
+        "kernel_type": build_options["kernel_type"],
+        "total_seconds": round(max(phase["start"] + phase["wall_seconds"] for phase in report_phases) -
+                               min(phase["start"] for phase in report_phases), 3) if report_phases else 0,
+        "phases": report_phases
+    }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+# The phases as Chrome trace events, to be shown above the commands of the command trace
+def phase_trace_events() -> list:
+    events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": 0, "args": {"name": "build phases"}}]
+    for phase in report_phases:
+        events.append({"name": phase["name"], "cat": "phase", "ph": "X", "ts": int(phase["start"] * 1000000),
+                       "dur": int(phase["wall_seconds"] * 1000000), "pid": os.getpid(), "tid": 0, "args": phase})
+    return events
+
+
+def print_build_report() -> None:
+    print_header("Build phases:")
+    print(f"{'Phase':<20}{'Wall':>10}{'CPU':>10}{'Peak RSS':>11}{'Read':>11}{'Written':>11}{'Network':>11}")
+    for phase in report_phases:
+        network = phase["network_received_bytes"] + phase["network_sent_bytes"]
+        print(f"{phase['name']:<20}{phase['wall_seconds']:>9.1f}s{phase['cpu_seconds']:>9.1f}s"
+              f"{phase['peak_rss_mb']:>9.0f}mb{phase['read_bytes'] / 1048576:>9.0f}mb"
+              f"{phase['written_bytes'] / 1048576:>9.0f}mb{network / 1048576:>9.0f}mb", flush=True)
+
+
+def _snapshot() -> dict:
+    times = os.times()
+    read_bytes, written_bytes = _io_bytes()
+    network_received, network_sent = _network_bytes()
+    return {
+        "time": time(),
+        "cpu": times.user + times.system + times.children_user + times.children_system,
+        "peak_rss": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),  # in kb
+        "read_bytes": read_bytes,
+        "written_bytes": written_bytes,
+        "network_received": network_received,
+        "network_sent": network_sent
+    }
+
+
+# Storage I/O of this process and its finished children, plus the children that are still running
+def _io_bytes() -> Tuple[int, int]:
+    pids = ["self"]
+    for task in Path("/proc/self/task").iterdir():
+        with contextlib.suppress(FileNotFoundError):  # thread exited or kernel without CONFIG_PROC_CHILDREN
+            pids.extend((task / "children").read_text().split())
+    read_bytes = written_bytes = 0
+    for pid in pids:
+        with contextlib.suppress(FileNotFoundError, ProcessLookupError, PermissionError):
+            with open(f"/proc/{pid}/io", "r") as file:
+                counters = dict(line.split(": ") for line in file.read().splitlines())
+            read_bytes += int(counters["read_bytes"])
+            written_bytes += int(counters["write_bytes"])
+    return read_bytes, written_bytes
+
+
+def _network_bytes() -> Tuple[int, int]:
+    received = sent = 0
+    with open("/proc/net/dev", "r") as file:
+        for line in file.readlines()[2:]:  # skip the 2 header lines
+            interface, counters = line.split(":", 1)
+            if interface.strip() == "lo":
+                continue
+            counters = counters.split()
+            received += int(counters[0])
+            sent += int(counters[8])
+    return received, sent
@@ -0,0 +1,274 @@
+# Command execution for the build, replacing bash() and chroot() of the vendored functions.py, which is overwritten by
+# the python-os-functions copy every night. Import them explicitly after "from functions import *".
+# Commands run in a single long-lived shell inside the chroot, can be cancelled by a failed build phase of run_phases
+# and can be recorded in a command trace.
+import contextlib
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Lock, Thread, current_thread, get_ident, local
+from time import time
+
+import functions
+from functions import *
+
+
+# return the output of a command
+# Sensitive commands, i.e. ones containing a password, are not shown in the command trace and in errors
+def bash(command: str, sensitive: bool = False) -> str:
+    check_cancelled()
+    with _trace_command("bash", command, sensitive) as trace:
+        output = trace["output"] = subprocess.check_output(command, shell=True, text=True).strip()
+    if functions.verbose:
+        print(output, flush=True)
+    return output
+
+
+# run a command inside /mnt/depthboot and return its output
+# All commands are sent to the same long-lived shell, see ChrootSession
+def chroot(command: str, timeout: float = None, sensitive: bool = False) -> str:
+    global chroot_session
+    if chroot_session is None or chroot_session.process.poll() is not None:
+        chroot_session = ChrootSession("/mnt/depthboot")
+    return chroot_session.run(command, timeout, sensitive)
+
+
+# Stop the shell inside the chroot. Has to be called before /mnt/depthboot is unmounted, as the shell keeps it busy.
+# If kill is set, running commands are killed instead of waiting for them.
+def close_chroot(kill: bool = False) -> None:
+    global chroot_session
+    if chroot_session is not None:
+        chroot_session.close(kill)
+        chroot_session = None
+
+
+# A bash process that keeps running inside a chroot and executes commands sent over a pipe.
+# Starting chroot + bash through a host shell for every command is slow and breaks commands with double quotes.
+# Each command is sent as a single line of hex escapes, to not require any quoting, and runs in a subshell with stdin
+# from /dev/null, so that it can neither change the environment of later commands nor read the following commands.
+# Its stdout is followed by a marker line with the exit status. stderr is passed through, like with bash().
+class ChrootSession:
+    def __init__(self, root: str):
+        self.marker = f"__depthboot_{os.urandom(8).hex()}__"
+        loop = ('while IFS= read -r line; do printf -v command "%b" "$line"; (eval "$command") </dev/null; '
+                f'printf "\\n{self.marker} %d\\n" "$?"; done')
+        # own session and process group, to be able to kill commands that timed out including their children
+        self.process = subprocess.Popen(["chroot", root, "/bin/bash", "--noprofile", "--norc", "-c", loop],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.lines = Queue()
+        self.lock = Lock()
+        Thread(target=self._read_output, daemon=True).start()
+
+    def _read_output(self) -> None:
+        for line in self.process.stdout:
+            self.lines.put(line.decode(errors="replace"))
+        self.lines.put(None)  # shell exited
+
+    def run(self, command: str, timeout: float = None, sensitive: bool = False) -> str:
+        with _trace_command("chroot", command, sensitive) as trace:
+            trace["output"] = self._run(command, timeout)
+        return trace["output"]
+
+    def _run(self, command: str, timeout: float = None) -> str:
+        with self.lock:
+            self.process.stdin.write("".join(f"\\x{byte:02x}" for byte in command.encode()).encode() + b"\n")
+            self.process.stdin.flush()
+            deadline = None if timeout is None else time() + timeout
+            output = []
+            while True:
+                try:
+                    # wake up regularly, to stop commands of a cancelled build phase
+                    line = self.lines.get(timeout=1 if deadline is None else min(max(deadline - time(), 0), 1))
+                except Empty:
+                    if phases_cancelled.is_set():
+                        self.close(kill=True)
+                        check_cancelled()
+                    if deadline is not None and time() >= deadline:
+                        self.close(kill=True)
+                        raise subprocess.TimeoutExpired(command, timeout, "".join(output))
+                    continue
+                if line is None:
+                    raise subprocess.CalledProcessError(self.process.wait(), command, "".join(output))
+                if line.startswith(self.marker):
+                    return_code = int(line.split()[1])
+                    break
+                output.append(line)
+        output = "".join(output).strip()
+        if functions.verbose:
+            print(output, flush=True)
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, command, output)
+        return output
+
+    def close(self, kill: bool = False) -> None:
+        if self.process.poll() is None and not kill:
+            self.process.stdin.close()  # the shell exits once it has no more commands to read
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                self.process.wait(timeout=10)
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, 9)
+            self.process.wait()
+
+
+# Raised in a build phase, after another phase that runs at the same time failed
+class PhaseCancelled(Exception):
+    pass
+
+
+def run_phases(*phases) -> list:
+    """
+    Run independent build phases at the same time, i.e. download the rootfs while the image is being partitioned.
+    If a phase fails or Ctrl+C is pressed, the other phases stop at their next command or downloaded chunk.
+
+    :param phases: Functions without arguments. The first one runs in the calling thread, to receive Ctrl+C.
+    :return: A list with the return values of the phases.
+    """
+    phases_cancelled.clear()
+    results = [None] * len(phases)
+    errors = []
+    trace_phase = get_trace_phase()
+
+    def run_phase(index: int) -> None:
+        set_trace_phase(trace_phase)  # commands of the phases belong to the calling phase, unless they set their own
+        try:
+            results[index] = phases[index]()
+        except BaseException as e:  # including sys.exit() and Ctrl+C
+            errors.append(e)
+            phases_cancelled.set()
+
+    threads = [Thread(target=run_phase, args=(index,), daemon=True) for index in range(1, len(phases))]
+    for thread in threads:
+        thread.start()
+    run_phase(0)
+    for thread in threads:
+        try:
+            thread.join()
+        except KeyboardInterrupt as e:  # Ctrl+C while waiting for the other phases
+            errors.append(e)
+            phases_cancelled.set()
+            thread.join()
+    phases_cancelled.clear()
+    # raise the error that caused the cancellation
+    for error in errors:
+        if not isinstance(error, PhaseCancelled):
+            raise error
+    return results
+
+
+def check_cancelled() -> None:
+    if phases_cancelled.is_set():
+        raise PhaseCancelled("Cancelled, as another build phase failed")
+
+
+#######################################################################################
+#                                    COMMAND TRACE                                    #
+#######################################################################################
+# If enabled, every bash() and chroot() command is recorded with its caller and exported in the Chrome trace event
+# format, which can be opened in chrome://tracing or https://ui.perfetto.dev
+
+def set_command_trace(enabled: bool) -> None:
+    global command_trace
+    command_trace = [] if enabled else None
+
+
+# name of the build phase the commands of the current thread belong to
+def set_trace_phase(phase: str) -> None:
+    trace_phase_local.name = phase
+
+
+def get_trace_phase() -> str:
+    return getattr(trace_phase_local, "name", "")
+
+
+def write_command_trace(path: str, extra_events: list = None) -> None:
+    """
+    Write the recorded commands as Chrome trace event JSON.
+
+    :param path: A string representing the full path to the trace file.
+    :param extra_events: Additional trace events, i.e. the build phases.
+    :return: None
+    """
+    events = list(command_trace or []) + (extra_events or [])
+    # name the threads in the timeline
+    for tid, thread_name in {event["tid"]: event["args"].get("thread", "") for event in command_trace or []}.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread_name}})
+    with open(path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+def print_slowest_commands(count: int = 10) -> None:
+    print_header("Slowest commands:")
+    for event in sorted(command_trace or [], key=lambda trace_event: trace_event["dur"], reverse=True)[:count]:
+        phase = f"[{event['args']['phase']}] " if event["args"]["phase"] else ""
+        print(f"{event['dur'] / 1000000:>8.1f}s {phase}{event['cat']}: {event['name']} "
+              f"({event['args']['source']})", flush=True)
+
+
+# Record the duration, exit status and output size of a command. The output has to be set in the yielded dict.
+# Sensitive commands are recorded as "<redacted>" and replaced by it in the raised errors.
+@contextlib.contextmanager
+def _trace_command(category: str, command: str, sensitive: bool = False):
+    trace = {"output": ""}
+    if sensitive:
+        command = "<redacted>"
+    if command_trace is None:
+        try:
+            yield trace
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            if sensitive:
+                e.cmd = command
+            raise e
+        return
+    # first caller outside of the helper modules, i.e. distro/arch.py:73
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_code.co_filename == contextlib.__file__ or
+                                 Path(frame.f_code.co_filename).name in _helper_modules):
+        frame = frame.f_back
+    source = f"{Path(frame.f_code.co_filename).name}:{frame.f_lineno}" if frame is not None else ""
+    start_time = time()
+    exit_status = 0
+    try:
+        yield trace
+    except subprocess.CalledProcessError as e:
+        exit_status = e.returncode
+        trace["output"] = e.output or ""
+        if sensitive:
+            e.cmd = command
+        raise e
+    except subprocess.TimeoutExpired as e:
+        exit_status = "timeout"
+        if sensitive:
+            e.cmd = command
+        raise e
+    except BaseException as e:  # i.e. Ctrl+C
+        exit_status = type(e).__name__
+        raise e
+    finally:
+        command_trace.append({
+            "name": command if len(command) <= 80 else f"{command[:77]}...",
+            "cat": category,
+            "ph": "X",  # complete event with a duration
+            "ts": int(start_time * 1000000),
+            "dur": int((time() - start_time) * 1000000),
+            "pid": os.getpid(),
+            "tid": get_ident(),
+            "args": {
+                "command": command,
+                "phase": get_trace_phase(),
+                "source": source,
+                "thread": current_thread().name,
+                "exit_status": exit_status,
+                "output_bytes": len(trace["output"].encode())
+            }
+        })
+
+
+chroot_session = None  # shell inside /mnt/depthboot, started by the first chroot() call
+phases_cancelled = Event()  # set when a phase of run_phases failed
+command_trace = None  # list of trace events, None = tracing disabled
+trace_phase_local = local()
+# modules that run commands on behalf of their callers, skipped when looking for the source of a traced command
+_helper_modules = ["commands.py", "downloads.py", "extract.py", "fileops.py", "progress.py", "transaction.py"]
@@ -1,8 +1,26 @@
 from functions import *
+from commands import bash, chroot
+from fileops import cpfile
+from mirrors import rank_mirrors
+from package_cache import mark_package_metadata_refreshed, package_metadata_fresh
+from transaction import Transaction
 from urllib.request import urlretrieve
 
+eupnea_key_fingerprint = "94EB01F3608D3940CE0F2A6D69E3E84DF85C8A12"
 
-def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str) -> None:
+
+# Packages of multiple build stages are installed in a single pacman run
+def new_transaction() -> Transaction:
+    return Transaction("pacman -S --noconfirm", "pacman -Sw --noconfirm", "pacman")
+
+
+def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str, shell: str) -> None:
+    config_de(config_base(distro_version, verbose, kernel_version), de_name, distro_version, shell)
+
+
+# Configure the distro up to the desktop environment. The returned transaction still has to be applied.
+# This part only depends on the distro version and kernel, i.e. is the same for every desktop environment.
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> Transaction:
     set_verbose(verbose)
     print_status("Configuring Arch")
 
@@ -11,100 +29,157 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
         mirrors = read.readlines()
     # Uncomment first worldwide mirror
     mirrors[6] = mirrors[6][1:]
-    with open("/mnt/depthboot/etc/pacman.d/mirrorlist", "w") as write:
+    with open("/mnt/depthboot/etc/pacman.d/mirrorlist.bak", "w") as write:
         write.writelines(mirrors)
+    # temporarily put the fastest mirrors for the build host on top of the mirrorlist
+    servers = [line.split("=", 1)[1].strip() for line in mirrors if line.startswith("#Server")]
+    fastest_servers = rank_mirrors(servers, lambda server: server.replace("$repo", "core").replace("$arch", "x86_64")
+                                   + "/core.db")
+    with open("/mnt/depthboot/etc/pacman.d/mirrorlist", "w") as write:
+        write.writelines([f"Server = {server}\n" for server in fastest_servers] + mirrors)
 
-    # temporarily comment out CheckSpace, coz Pacman fails to check available storage space when run from a chroot
+    cpfile("/mnt/depthboot/etc/pacman.conf", "/mnt/depthboot/etc/pacman.conf.bak")
     with open("/mnt/depthboot/etc/pacman.conf", "r") as conf:
         temp_pacman = conf.readlines()
+    # temporarily comment out CheckSpace, coz Pacman fails to check available storage space when run from a chroot
     temp_pacman[34] = f"#{temp_pacman[34]}"
+    # temporarily download multiple packages at the same time
+    for index, line in enumerate(temp_pacman):
+        if line.lstrip("#").startswith("ParallelDownloads"):
+            temp_pacman[index] = "ParallelDownloads = 10\n"
     with open("/mnt/depthboot/etc/pacman.conf", "w") as conf:
         conf.writelines(temp_pacman)
 
     print_status("Preparing pacman")
-    chroot("pacman-key --init")
-    chroot("pacman-key --populate archlinux")
-    # Add eupnea repo to pacman.conf
-    urlretrieve("https://eupnea-linux.github.io/arch-repo/public_key.gpg", filename="/mnt/depthboot/tmp/eupnea.key")
-    # arch-chroot clears /tmp, so we hae to use normal chroot
-    bash("chroot /mnt/depthboot bash -c 'pacman-key --add /tmp/eupnea.key'")
-    chroot("pacman-key --lsign-key 94EB01F3608D3940CE0F2A6D69E3E84DF85C8A12")
-    # add repo to pacman.conf
-    with open("/mnt/depthboot/etc/pacman.conf", "a") as file:
-        file.write("[eupnea]\nServer = https://eupnea-linux.github.io/arch-repo/repodata/$arch\n")
-    chroot("pacman -Syyu --noconfirm")  # update the whole system
+    init_keyring()
+    # Add eupnea repo to pacman.conf and its backup
+    for pacman_conf in ["/mnt/depthboot/etc/pacman.conf", "/mnt/depthboot/etc/pacman.conf.bak"]:
+        with open(pacman_conf, "a") as file:
+            file.write("[eupnea]\nServer = https://eupnea-linux.github.io/arch-repo/repodata/$arch\n")
+    if package_metadata_fresh():
+        chroot("pacman -Su --noconfirm")  # update the whole system with the cached sync dbs
+    else:
+        chroot("pacman -Syyu --noconfirm")  # update the whole system
+        mark_package_metadata_refreshed()
 
     print_status("Installing packages")
     # Install basic utils
     chroot(
         "pacman -S --noconfirm --needed base base-devel nano networkmanager xkeyboard-config linux-firmware sudo bluez "
         "bluez-utils python3 cgpt-vboot-utils zram-generator")
+    # Packages of all following stages are installed in one pacman run, to only resolve dependencies and run hooks once
+    transaction = new_transaction()
     # install eupnea packages after installing python3
-    chroot("pacman -S --noconfirm eupnea-utils eupnea-system")
+    transaction.install("eupnea-utils eupnea-system")
     # Install kernel
-    chroot(f"pacman -S --noconfirm eupnea-{kernel_version}-kernel")
+    transaction.install(f"eupnea-{kernel_version}-kernel")
+    return transaction
+
+
+# Continue from a cached base layer. The layer does not contain the pacman keyring, as the private master key of the
+# keyring has to be unique per image.
+def config_restored_base(distro_version: str, verbose: bool) -> Transaction:
+    set_verbose(verbose)
+    print_status("Preparing pacman")
+    init_keyring()
+    # the sync dbs of the layer might be outdated already and mirrors remove superseded packages right away
+    chroot("pacman -Syu --noconfirm")
+    mark_package_metadata_refreshed()
+    return new_transaction()
+
+
+# Generate a new keyring with the arch and eupnea keys.
+# Each image gets its own master key, which signs the trusted keys.
+def init_keyring() -> None:
+    urlretrieve("https://eupnea-linux.github.io/arch-repo/public_key.gpg", filename="/mnt/depthboot/tmp/eupnea.key")
+    chroot("pacman-key --init")
+    chroot("pacman-key --populate archlinux")
+    # Add eupnea key to the keyring
+    chroot("pacman-key --add /tmp/eupnea.key")
+    chroot(f"pacman-key --lsign-key {eupnea_key_fingerprint}")
+    # pacman-key starts a gpg-agent, which would keep the image busy
+    chroot("gpgconf --homedir /etc/pacman.d/gnupg --kill gpg-agent")
+
+
+# Install and configure the desktop environment and shell on top of the base system
+def config_de(transaction: Transaction, de_name: str, distro_version: str, shell: str) -> None:
+
+    match de_name:
+        case "gnome":
+            print_status("Adding GNOME to install")
+            transaction.install("gnome gnome-extra")
+        case "kde":
+            print_status("Adding KDE to install")
+            transaction.install("plasma-meta plasma-wayland-session kde-system-meta kde-utilities-meta packagekit-qt5 "
+                                "firefox")
+        case "xfce":
+            print_status("Adding Xfce to install")
+            # no wayland support in xfce
+            # xfce doesn't have proper audio settings and uses pavucontrol instead
+            # xfce does not have any audio servers as dependencies -> manually install pipewire
+            transaction.install("xfce4 xfce4-goodies xorg xorg-server lightdm lightdm-gtk-greeter "
+                                "network-manager-applet nm-connection-editor xfce4-pulseaudio-plugin pavucontrol "
+                                "pipewire gnome-software firefox wireplumber")
+        case "lxqt":
+            print_status("Adding LXQt to install")
+            transaction.install("lxqt breeze-icons xorg xorg-server sddm firefox networkmanager-qt "
+                                "network-manager-applet nm-connection-editor discover packagekit-qt5")
+        case "deepin":
+            print_status("Adding deepin to install")
+            transaction.install("deepin deepin-kwin deepin-extra xorg xorg-server lightdm kde-applications firefox "
+                                "discover packagekit-qt5")
+        case "budgie":
+            print_status("Adding Budgie to install")
+            transaction.install("lightdm lightdm-gtk-greeter budgie-desktop budgie-desktop-view budgie-screensaver "
+                                "budgie-control-center xorg xorg-server network-manager-applet gnome-terminal firefox "
+                                "gnome-software nemo")
+        case "cinnamon":
+            print_status("Adding Cinnamon to install")
+            transaction.install("cinnamon cinnamon-translations lightdm lightdm-gtk-greeter xed xreader gnome-terminal "
+                                "system-config-printer gnome-keyring blueberry")
+        case "cli":
+            print_status("Skipping desktop environment install")
+        case _:
+            print_error(f"Invalid desktop environment: {de_name}. Please create an issue")
+            exit(1)
+
+    if de_name != "cli":
+        # auto-rotate service, keyd
+        transaction.install("iio-sensor-proxy keyd")
+
+    if shell != "bash":  # bash is preinstalled
+        transaction.install(shell)
+
+    print_status("Downloading and installing packages and de, might take a while")
+    transaction.apply()
 
-    print_status("Downloading and installing de, might take a while")
+    print_status("Configuring de")
     match de_name:
         case "gnome":
-            print_status("Installing GNOME")
-            chroot("pacman -S --noconfirm gnome gnome-extra")
             chroot("systemctl enable gdm.service")
         case "kde":
-            print_status("Installing KDE")
-            chroot("pacman -S --noconfirm plasma-meta plasma-wayland-session kde-system-meta kde-utilities-meta "
-                   "packagekit-qt5 firefox")
             chroot("systemctl enable sddm.service")
             # Set default kde sddm theme
             mkdir("/mnt/depthboot/etc/sddm.conf.d")
             with open("/mnt/depthboot/etc/sddm.conf.d/breeze-theme.conf", "a") as conf:
                 conf.write("[Theme]\nCurrent=breeze")
         case "xfce":
-            print_status("Installing Xfce")
-            # no wayland support in xfce
-            # xfce doesn't have proper audio settings and uses pavucontrol instead
-            # xfce does not have any audio servers as dependencies -> manually install pipewire
-            chroot("pacman -S --noconfirm xfce4 xfce4-goodies xorg xorg-server lightdm lightdm-gtk-greeter network-"
-                   "manager-applet nm-connection-editor xfce4-pulseaudio-plugin pavucontrol pipewire gnome-software "
-                   "firefox wireplumber")
             chroot("systemctl enable lightdm.service")
         case "lxqt":
-            print_status("Installing LXQt")
-            chroot("pacman -S --noconfirm lxqt breeze-icons xorg xorg-server sddm firefox networkmanager-qt "
-                   "network-manager-applet nm-connection-editor discover packagekit-qt5")
             chroot("systemctl enable sddm.service")
         case "deepin":
-            print_status("Installing deepin")
-            chroot("pacman -S --noconfirm deepin deepin-kwin deepin-extra xorg xorg-server lightdm kde-applications "
-                   "firefox discover packagekit-qt5")
             # enable deepin specific login style
             with open("/mnt/depthboot/etc/lightdm/lightdm.conf", "a") as conf:
                 conf.write("greeter-session=lightdm-deepin-greeter")
             chroot("systemctl enable lightdm.service")
         case "budgie":
-            print_status("Installing Budgie")
-            chroot("pacman -S --noconfirm lightdm lightdm-gtk-greeter budgie-desktop budgie-desktop-view "
-                   "budgie-screensaver budgie-control-center xorg xorg-server network-manager-applet gnome-terminal"
-                   " firefox gnome-software nemo")
             chroot("systemctl enable lightdm.service")
             # remove broken gnome xsessions
             chroot("rm /usr/share/xsessions/gnome.desktop")
             chroot("rm /usr/share/xsessions/gnome-xorg.desktop")
         case "cinnamon":
-            print_status("Installing Cinnamon")
-            chroot("pacman -S --noconfirm cinnamon cinnamon-translations lightdm lightdm-gtk-greeter xed xreader "
-                   "gnome-terminal system-config-printer gnome-keyring blueberry")
             chroot("systemctl enable lightdm.service")
             chroot("systemctl enable NetworkManager.service")
-        case "cli":
-            print_status("Skipping desktop environment install")
-        case _:
-            print_error(f"Invalid desktop environment: {de_name}. Please create an issue")
-            exit(1)
-
-    if de_name != "cli":
-        print_status("Installing auto-rotate service, keyd")
-        chroot("pacman -S --noconfirm iio-sensor-proxy keyd")
 
     print_status("Desktop environment setup complete")
 
@@ -122,23 +197,12 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
         conf.write("%wheel ALL=(ALL:ALL) ALL")  # enable wheel group to use sudo
 
     print_status("Restoring pacman config")
-    with open("/mnt/depthboot/etc/pacman.conf", "r") as conf:
-        temp_pacman = conf.readlines()
-    # comment out CheckSpace
-    temp_pacman[34] = temp_pacman[34][1:]
-    with open("/mnt/depthboot/etc/pacman.conf", "w") as conf:
-        conf.writelines(temp_pacman)
+    for config_file in ["/mnt/depthboot/etc/pacman.conf", "/mnt/depthboot/etc/pacman.d/mirrorlist"]:
+        cpfile(f"{config_file}.bak", config_file)
+        rmfile(f"{config_file}.bak")
 
-    # Kill the gpg-agent processes, as they prevent the image from being unmounted later
-    # Find the pids of the correct gpg-agent processes
-    gpg_pids = []
-    for line in bash("ps aux").split("\n"):
-        if "gpg-agent --homedir /etc/pacman.d/gnupg --use-standard-socket --daemon" in line:
-            temp_string = line[line.find(" "):].strip()
-            gpg_pids.append(temp_string[:temp_string.find(" ")])
-
-    for pid in gpg_pids:
-        print(f"Killing gpg-agent proces with pid: {pid}")
-        bash(f"kill {pid}")
+    # Stop the gpg-agent, as it prevents the image from being unmounted later
+    # Keyring package updates repopulate the keyring and start a new agent
+    chroot("gpgconf --homedir /etc/pacman.d/gnupg --kill gpg-agent")
 
     print_status("Arch setup complete")
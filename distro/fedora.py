@@ -1,11 +1,28 @@
 from functions import *
+from commands import bash, chroot
+from fileops import cpfile
+from package_cache import mark_package_metadata_refreshed, package_metadata_fresh
+from transaction import Transaction
 
 
-def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str) -> None:
+# Packages and groups of multiple build stages are installed in a single dnf run
+def new_transaction() -> Transaction:
+    return Transaction("dnf install -y", "dnf")
+
+
+def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str, shell: str) -> None:
+    config_de(config_base(distro_version, verbose, kernel_version), de_name, distro_version, shell)
+
+
+# Configure the distro up to the desktop environment. The returned transaction still has to be applied.
+# This part only depends on the distro version and kernel, i.e. is the same for every desktop environment.
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> Transaction:
     set_verbose(verbose)
     print_status("Configuring Fedora")
 
     # Tweak dnf config to enable multithreaded downloads
+    # The original config is restored from the backup at the end of config_de
+    cpfile("/mnt/depthboot/etc/dnf/dnf.conf", "/mnt/depthboot/etc/dnf/dnf.conf.bak")
     with open("/mnt/depthboot/etc/dnf/dnf.conf", "r") as f:
         og_dnf_conf = f.read()
     new_dnf_conf = og_dnf_conf.replace("installonly_limit=3", "installonly_limit=0")
@@ -17,67 +34,93 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
     chroot(f"dnf install -y --releasever={distro_version} fedora-release")  # update repos list
     # Add eupnea repo
     chroot("dnf config-manager --add-repo https://eupnea-linux.github.io/rpm-repo/eupnea.repo")
-    chroot("dnf update --refresh -y")  # update repos
+    if package_metadata_fresh():
+        chroot("dnf update -y")  # cached repo metadata is recent enough
+    else:
+        chroot("dnf update --refresh -y")  # update repos
+        mark_package_metadata_refreshed()
+    # Packages and groups of all stages are installed in one dnf run, to only resolve dependencies once
+    transaction = new_transaction()
     # Install eupnea packages
-    chroot("dnf install -y eupnea-system eupnea-utils")
+    transaction.install("eupnea-system eupnea-utils")
     # Install kernel
-    chroot(f"dnf install -y eupnea-{kernel_version}-kernel")
+    transaction.install(f"eupnea-{kernel_version}-kernel")
     # Install core packages
-    chroot("dnf group install -y 'Core'")
+    transaction.install_group("Core")
     # Install firmware packages
-    chroot("dnf group install -y 'Hardware Support'")
-    chroot("dnf group install -y 'Common NetworkManager Submodules'")
-    chroot("dnf install -y linux-firmware")
+    transaction.install_group("Hardware Support")
+    transaction.install_group("Common NetworkManager Submodules")
+    transaction.install("linux-firmware")
+    return transaction
+
+
+# Continue from a cached base layer. Its repo metadata might be outdated already -> always refresh it.
+def config_restored_base(distro_version: str, verbose: bool) -> Transaction:
+    set_verbose(verbose)
+    chroot("dnf update --refresh -y")
+    mark_package_metadata_refreshed()
+    return new_transaction()
+
+
+# Install and configure the desktop environment and shell on top of the base system
+def config_de(transaction: Transaction, de_name: str, distro_version: str, shell: str) -> None:
 
-    print_status("Downloading and installing DE, might take a while")
     match de_name:
         case "gnome":
-            print_status("Installing GNOME")
-            chroot("dnf group install -y 'Fedora Workstation'")  # Fedora has gnome by default in a workstation install
-            chroot("dnf install -y firefox")
+            print_status("Adding GNOME to install")
+            transaction.install_group("Fedora Workstation")  # Fedora has gnome by default in a workstation install
+            transaction.install("firefox")
         case "kde":
-            print_status("Installing KDE")
-            chroot("dnf group install -y 'KDE Plasma Workspaces'")
-            chroot("dnf install -y firefox")
+            print_status("Adding KDE to install")
+            transaction.install_group("KDE Plasma Workspaces")
+            transaction.install("firefox")
         case "xfce":
-            print_status("Installing Xfce")
-            chroot("dnf group install -y 'Xfce Desktop'")
-            chroot("dnf install -y firefox gnome-software xfce4-pulseaudio-plugin")
+            print_status("Adding Xfce to install")
+            transaction.install_group("Xfce Desktop")
+            transaction.install("firefox gnome-software xfce4-pulseaudio-plugin")
         case "lxqt":
-            print_status("Installing LXQt")
-            chroot("dnf group install -y 'LXQt Desktop'")
-            chroot("dnf install -y plasma-discover")
+            print_status("Adding LXQt to install")
+            transaction.install_group("LXQt Desktop")
+            transaction.install("plasma-discover")
         case "deepin":
-            print_status("Installing deepin")
-            chroot("dnf group install -y 'Deepin Desktop'")
-            chroot("dnf install -y plasma-discover")
+            print_status("Adding deepin to install")
+            transaction.install_group("Deepin Desktop")
+            transaction.install("plasma-discover")
         case "budgie":
-            print_status("Installing Budgie")
-            chroot("dnf install -y budgie-desktop lightdm lightdm-gtk xorg-x11-server-Xorg gnome-terminal firefox "
-                   "gnome-software nemo")
+            print_status("Adding Budgie to install")
+            transaction.install("budgie-desktop lightdm lightdm-gtk xorg-x11-server-Xorg gnome-terminal firefox "
+                                "gnome-software nemo")
         case "cinnamon":
-            print_status("Installing Cinnamon")
-            chroot("dnf group install -y 'Cinnamon Desktop'")
+            print_status("Adding Cinnamon to install")
+            transaction.install_group("Cinnamon Desktop")
         case "cli":
             print_status("Skipping desktop environment install")
             # install network tui
-            chroot("dnf install -y NetworkManager-tui")
+            transaction.install("NetworkManager-tui")
         case _:
             print_error("Invalid desktop environment! Please create an issue")
             exit(1)
 
+    if de_name != "cli":
+        # install keyd
+        transaction.install("keyd")
+
+    if shell != "bash":  # bash is preinstalled
+        transaction.install(shell)
+
+    print_status("Downloading and installing packages and DE, might take a while")
+    transaction.apply()
+
     if de_name != "cli":
         # Set system to boot to gui
         chroot("systemctl set-default graphical.target")
-        # install keyd
-        chroot("dnf install -y keyd")
     print_status("Desktop environment setup complete")
 
     # Add zram config
     cpfile("configs/zram/zram-generator.conf", "/mnt/depthboot/etc/systemd/zram-generator.conf")
 
     # Restore dnf config
-    with open("/mnt/depthboot/etc/dnf/dnf.conf", "w") as f:
-        f.write(og_dnf_conf)
+    cpfile("/mnt/depthboot/etc/dnf/dnf.conf.bak", "/mnt/depthboot/etc/dnf/dnf.conf")
+    rmfile("/mnt/depthboot/etc/dnf/dnf.conf.bak")
 
     print_status("Fedora setup complete")
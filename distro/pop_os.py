@@ -1,8 +1,24 @@
 from functions import *
+from commands import bash, chroot
+from fileops import cpfile
+from package_cache import mark_package_metadata_refreshed, package_metadata_fresh
+from transaction import Transaction
 from urllib.request import urlretrieve
 
 
+# Packages of multiple build stages are installed and removed in a single apt-get run.
+# apt-get install removes packages with a trailing "-".
+def new_transaction() -> Transaction:
+    return Transaction("apt-get install -y", "apt", remove_suffix="-")
+
+
 def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str, shell: str) -> None:
+    config_de(config_base(distro_version, verbose, kernel_version), de_name, distro_version, shell)
+
+
+# Configure the distro up to the desktop environment. The returned transaction still has to be applied.
+# This part only depends on the distro version and kernel, i.e. is the same for every desktop environment.
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> Transaction:
     set_verbose(verbose)
     print_status("Configuring Pop!_OS")
 
@@ -22,23 +38,47 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
                    "apt-repo/debian_ubuntu jammy main")
     # update apt
     print_status("Updating and upgrading all packages")
-    chroot("apt-get update -y")
+    if not package_metadata_fresh():  # cached package lists might be recent enough
+        chroot("apt-get update -y")
+        mark_package_metadata_refreshed()
     # TODO: Remove this once the iso is updated
     # This file was updated in the remote package, but not on the iso. This results in apt prompting on what to do
     # -> just copy over the new file from the package
     cpfile("configs/pop-os/20apt-esm-hook.conf", "/mnt/depthboot/etc/apt/apt.conf.d/20apt-esm-hook.conf")
     chroot("apt-get upgrade -y")
-    print_status("Installing eupnea packages")
+    # Packages of all stages are installed in one apt run, to only resolve dependencies and run triggers once
+    transaction = new_transaction()
     # Install eupnea packages
-    chroot("apt-get install -y eupnea-utils eupnea-system keyd")
-
+    transaction.install("eupnea-utils eupnea-system keyd")
     # Install kernel
-    chroot(f"apt-get install -y eupnea-{kernel_version}-kernel")
+    transaction.install(f"eupnea-{kernel_version}-kernel")
+    return transaction
 
+
+# Continue from a cached base layer. Its package lists might be outdated already -> always update them.
+def config_restored_base(distro_version: str, verbose: bool) -> Transaction:
+    set_verbose(verbose)
+    print_status("Updating and upgrading all packages")
+    chroot("apt-get update -y")
+    mark_package_metadata_refreshed()
+    chroot("apt-get upgrade -y")
+    return new_transaction()
+
+
+# Install and configure the desktop environment and shell on top of the base system
+def config_de(transaction: Transaction, de_name: str, distro_version: str, shell: str) -> None:
     # Replace input-synaptics with newer input-libinput, for better touchpad support
-    print_status("Upgrading touchpad drivers")
-    chroot("apt-get remove -y xserver-xorg-input-synaptics")
-    chroot("apt-get install -y xserver-xorg-input-libinput")
+    transaction.remove("xserver-xorg-input-synaptics")
+    transaction.install("xserver-xorg-input-libinput")
+    match shell:
+        case "bash":
+            pass  # bash is preinstalled, no need to install anything
+        case "fish":
+            transaction.install("fish")
+        case "zsh":
+            transaction.install("zsh")
+    print_status("Installing packages and touchpad drivers")
+    transaction.apply()
 
     # Enable wayland
     print_status("Enabling Wayland")
@@ -48,14 +88,4 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
         file.write(gdm_config.replace("WaylandEnable=false", "#WaylandEnable=false"))
     # TODO: Set wayland as default
 
-    match shell:
-        case "bash":
-            pass # bash is preinstalled, no need to install anything
-        case "fish":
-            print_status("Installing fish")
-            chroot("apt-get install -y fish")
-        case "fish":
-            print_status("Installing zsh")
-            chroot("apt-get install -y zsh")
-
     print_status("Pop!_OS setup complete")
@@ -1,21 +1,71 @@
 import contextlib
+import http.client
+from urllib.parse import urlsplit
 from urllib.request import urlretrieve
 import os
 from functions import *
+from commands import bash, chroot
+from fileops import cpfile
+from mirrors import rank_mirrors
+from package_cache import mark_package_metadata_refreshed, package_metadata_fresh
+from transaction import Transaction
+
+ubuntu_archive = "http://archive.ubuntu.com/ubuntu/"
+ubuntu_versions_codenames = {
+    "18.04": "bionic",
+    "20.04": "focal",
+    "21.04": "hirsute",
+    "22.04": "jammy",
+    "22.10": "kinetic",
+    "23.04": "lunar"
+}
+
+
+# Packages of multiple build stages are installed and removed in a single apt-get run.
+# apt-get install removes packages with a trailing "-". The packages are downloaded from mirror, empty =
+# archive.ubuntu.com.
+def new_transaction(mirror: str = "") -> Transaction:
+    return Transaction("DEBIAN_FRONTEND=noninteractive apt-get install -y", "apt", remove_suffix="-",
+                       environment=lambda: use_mirror(mirror))
+
+
+# Temporarily download from another Ubuntu mirror instead of archive.ubuntu.com.
+# apt names its package lists after the repo url -> rename them too, so that the lists in the image and the package
+# cache always belong to archive.ubuntu.com.
+@contextlib.contextmanager
+def use_mirror(mirror: str):
+    if not mirror:
+        yield
+        return
+    _switch_mirror(ubuntu_archive, mirror)
+    try:
+        yield
+    finally:
+        _switch_mirror(mirror, ubuntu_archive)
+
+
+def _switch_mirror(old_mirror: str, new_mirror: str) -> None:
+    with open("/mnt/depthboot/etc/apt/sources.list", "r") as file:
+        sources = file.read()
+    with open("/mnt/depthboot/etc/apt/sources.list", "w") as file:
+        file.write(sources.replace(old_mirror.rstrip("/"), new_mirror.rstrip("/")))
+    # i.e. http://archive.ubuntu.com/ubuntu/ -> archive.ubuntu.com_ubuntu_
+    old_prefix, new_prefix = [(urlsplit(mirror).netloc + urlsplit(mirror).path.rstrip("/")).replace("/", "_") + "_"
+                              for mirror in (old_mirror, new_mirror)]
+    for list_file in Path("/mnt/depthboot/var/lib/apt/lists").glob(f"{old_prefix}*"):
+        list_file.rename(list_file.with_name(new_prefix + list_file.name.removeprefix(old_prefix)))
 
 
 def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str, shell: str) -> None:
+    config_de(config_base(distro_version, verbose, kernel_version), de_name, distro_version, shell)
+
+
+# Configure the distro up to the desktop environment. The returned transaction still has to be applied.
+# This part only depends on the distro version and kernel, i.e. is the same for every desktop environment.
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> Transaction:
     set_verbose(verbose)
     print_status("Configuring Ubuntu")
 
-    ubuntu_versions_codenames = {
-        "18.04": "bionic",
-        "20.04": "focal",
-        "21.04": "hirsute",
-        "22.04": "jammy",
-        "22.10": "kinetic",
-        "23.04": "lunar"
-    }
     # add missing apt sources
     with open("/mnt/depthboot/etc/apt/sources.list", "a") as file:
         file.write(f"\ndeb http://archive.ubuntu.com/ubuntu {ubuntu_versions_codenames[distro_version]}-backports main "
@@ -34,72 +84,87 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
     with open("/mnt/depthboot/etc/apt/sources.list.d/eupnea.list", "w") as file:
         file.write("deb [signed-by=/usr/local/share/keyrings/eupnea.key] https://eupnea-linux.github.io/"
                    f"apt-repo/debian_ubuntu {ubuntu_versions_codenames[distro_version]} main")
-    # update apt
-    chroot("apt-get update -y")
-    chroot("apt-get upgrade -y")
-    # Install general dependencies + eupnea packages
-    chroot("apt-get install -y linux-firmware network-manager software-properties-common nano eupnea-utils "
-           "eupnea-system")
 
+    mirror = find_mirror(distro_version)
+
+    # update apt, unless the cached package lists are recent enough
+    metadata_fresh = package_metadata_fresh()
+    with use_mirror(mirror):
+        if not metadata_fresh:
+            chroot("apt-get update -y")
+        chroot("apt-get upgrade -y")
+    if not metadata_fresh:
+        # stamp after the sources point to archive.ubuntu.com again, as the freshness check hashes those sources
+        mark_package_metadata_refreshed()
+
+    # Packages of all stages are installed in one apt run, to only resolve dependencies and run triggers once
+    transaction = new_transaction(mirror)
+    # Install general dependencies + eupnea packages
+    transaction.install("linux-firmware network-manager software-properties-common nano eupnea-utils eupnea-system")
     # Install kernel
-    chroot(f"apt-get install -y eupnea-{kernel_version}-kernel")
+    transaction.install(f"eupnea-{kernel_version}-kernel")
+    return transaction
 
-    print_status("Installing zram, ignore dpkg errors")
-    # Install zram
-    # The apt postinstall of this zram packages tries to modload zram which is not possible in a chroot -> ignore errors
-    with contextlib.suppress(subprocess.CalledProcessError):
-        chroot("apt-get install -y systemd-zram-generator")
-    # Edit the postinstall script to force success
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "r") as file:
-        config = file.read()
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
-        file.write("#!/bin/sh\nexit 0\n")
-    # Rerun dpkg configuration for package to be recognized as installed
-    # for some reason on some systems dpkg says that the package is already installed -> ignore it
-    with contextlib.suppress(subprocess.CalledProcessError):
-        chroot("dpkg --configure systemd-zram-generator")
-    # Restore postinstall script
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
-        file.write(config)
 
-    print_status("Downloading and installing de, might take a while")
+# Continue from a cached base layer. Its package lists might be outdated already -> always update them.
+def config_restored_base(distro_version: str, verbose: bool) -> Transaction:
+    set_verbose(verbose)
+    print_status("Updating and upgrading all packages")
+    mirror = find_mirror(distro_version)
+    with use_mirror(mirror):
+        chroot("apt-get update -y")
+        chroot("apt-get upgrade -y")
+    mark_package_metadata_refreshed()  # after the sources point to archive.ubuntu.com again
+    return new_transaction(mirror)
+
+
+# Find the fastest Ubuntu mirror for the build host. Returns an empty string if archive.ubuntu.com is the fastest.
+def find_mirror(distro_version: str) -> str:
+    try:
+        with urlopen("http://mirrors.ubuntu.com/mirrors.txt", timeout=10) as response:
+            mirrors = response.read().decode().split()
+    except (OSError, http.client.HTTPException):
+        mirrors = []
+    fastest_mirrors = rank_mirrors([ubuntu_archive] + [mirror.rstrip("/") + "/" for mirror in mirrors],
+                                   lambda mirror: f"{mirror}dists/{ubuntu_versions_codenames[distro_version]}/Release",
+                                   count=1)
+    return fastest_mirrors[0] if fastest_mirrors and fastest_mirrors[0] != ubuntu_archive else ""
+
+
+# Install and configure the desktop environment and shell on top of the base system
+def config_de(transaction: Transaction, de_name: str, distro_version: str, shell: str) -> None:
+
     match de_name:
         case "gnome":
-            print_status("Installing GNOME")
-            chroot("apt-get install -y ubuntu-desktop gnome-software epiphany-browser wireplumber")
+            print_status("Adding GNOME to install")
+            transaction.install("ubuntu-desktop gnome-software epiphany-browser wireplumber")
         case "kde":
-            print_status("Installing KDE")
-            chroot("DEBIAN_FRONTEND=noninteractive apt-get install -y kde-standard plasma-workspace-wayland "
-                   "sddm-theme-breeze wireplumber")
+            print_status("Adding KDE to install")
+            transaction.install("kde-standard plasma-workspace-wayland sddm-theme-breeze wireplumber")
         case "xfce":
-            print_status("Installing Xfce")
+            print_status("Adding Xfce to install")
             # install xfce without heavy unnecessary packages
-            chroot("apt-get install -y xubuntu-desktop gimp- gnome-font-viewer- gnome-mines- gnome-sudoku- gucharmap-"
-                   " hexchat- libreoffice-*- mate-calc- pastebinit- synaptic- thunderbird- transmission-gtk-")
-            chroot("apt-get install -y nano gnome-software epiphany-browser")
+            transaction.install("xubuntu-desktop nano gnome-software epiphany-browser")
+            transaction.remove("gimp gnome-font-viewer gnome-mines gnome-sudoku gucharmap hexchat libreoffice-* "
+                               "mate-calc pastebinit synaptic thunderbird transmission-gtk")
         case "lxqt":
-            print_status("Installing LXQt")
-            chroot("apt-get install -y lubuntu-desktop discover konqueror")
+            print_status("Adding LXQt to install")
+            transaction.install("lubuntu-desktop discover konqueror")
         case "deepin":
-            print_status("Installing deepin")
-            chroot("add-apt-repository -y ppa:ubuntudde-dev/stable")
-            chroot("apt-get update -y")
-            with contextlib.suppress(subprocess.CalledProcessError):
-                chroot("apt-get install -y ubuntudde-dde")
-            # remove dpkg deepin-anything files to avoid dpkg errors
-            # These are later reinstated by the postinstall script
-            for file in os.listdir("/mnt/depthboot/var/lib/dpkg/info/"):
-                if file.startswith("deepin-anything-"):
-                    rmfile(f"/mnt/depthboot/var/lib/dpkg/info/{file}")
-            chroot("apt-get install -y discover konqueror")
+            print_status("Adding deepin PPA")
+            # ubuntudde-dde fails to install in a chroot and is installed separately after the transaction
+            with transaction.environment():  # download from the mirror of the transaction
+                chroot("add-apt-repository -y ppa:ubuntudde-dev/stable")
+                chroot("apt-get update -y")
+            transaction.install("discover konqueror")
         case "budgie":
-            print_status("Installing Budgie")
+            print_status("Adding Budgie to install")
             # do not install tex-common, it breaks the installation
-            chroot("DEBIAN_FRONTEND=noninteractive apt-get install -y lightdm lightdm-gtk-greeter ubuntu-budgie-desktop"
-                   " tex-common-")
+            transaction.install("lightdm lightdm-gtk-greeter ubuntu-budgie-desktop")
+            transaction.remove("tex-common")
         case "cinnamon":
-            print_status("Installing Cinnamon")
-            chroot("apt-get install -y cinnamon-desktop-environment")
+            print_status("Adding Cinnamon to install")
+            transaction.install("cinnamon-desktop-environment")
         case "cli":
             print_status("Skipping desktop environment install")
         case _:
@@ -108,31 +173,58 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
 
     match shell:
         case "bash":
-            pass # bash is preinstalled, no need to install anything
-        case "fish":
-            print_status("Installing fish")
-            chroot("apt-get install -y fish")
+            pass  # bash is preinstalled, no need to install anything
         case "fish":
-            print_status("Installing zsh")
-            chroot("apt-get install -y zsh")        
+            transaction.install("fish")
+        case "zsh":
+            transaction.install("zsh")
 
     if de_name != "cli":
         # Replace input-synaptics with newer input-libinput, for better touchpad support
-        print_status("Upgrading touchpad drivers")
-        chroot("apt-get remove -y xserver-xorg-input-synaptics")
-        chroot("apt-get install -y xserver-xorg-input-libinput")
-        print_status("Installing keyd")
-        chroot("apt-get install -y keyd")
+        transaction.remove("xserver-xorg-input-synaptics")
+        transaction.install("xserver-xorg-input-libinput keyd")
 
         # Install libasound2 backport on jammy
         if distro_version == "22.04":
-            chroot("apt-get install -y libasound2-eupnea")
+            transaction.install("libasound2-eupnea")
+
+    print_status("Downloading and installing packages, might take a while")
+    transaction.apply()
+
+    if de_name == "deepin":
+        print_status("Installing deepin")
+        with contextlib.suppress(subprocess.CalledProcessError), transaction.environment():
+            chroot("apt-get install -y ubuntudde-dde")
+        # remove dpkg deepin-anything files to avoid dpkg errors
+        # These are later reinstated by the postinstall script
+        for file in os.listdir("/mnt/depthboot/var/lib/dpkg/info/"):
+            if file.startswith("deepin-anything-"):
+                rmfile(f"/mnt/depthboot/var/lib/dpkg/info/{file}")
+
+    print_status("Installing zram, ignore dpkg errors")
+    # Install zram
+    # The apt postinstall of this zram packages tries to modload zram which is not possible in a chroot -> ignore errors
+    with contextlib.suppress(subprocess.CalledProcessError), transaction.environment():
+        chroot("apt-get install -y systemd-zram-generator")
+    # Edit the postinstall script to force success
+    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "r") as file:
+        config = file.read()
+    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
+        file.write("#!/bin/sh\nexit 0\n")
+    # Rerun dpkg configuration for package to be recognized as installed
+    # for some reason on some systems dpkg says that the package is already installed -> ignore it
+    with contextlib.suppress(subprocess.CalledProcessError):
+        chroot("dpkg --configure systemd-zram-generator")
+    # Restore postinstall script
+    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
+        file.write(config)
 
     # GDM3 auto installs gnome-minimal. Gotta remove it if user didn't choose gnome
+    # Has to run after all installs, as they pull it back in
     if de_name != "gnome":
         rmfile("/mnt/depthboot/usr/share/xsessions/ubuntu.desktop")
-        chroot("apt-get remove -y gnome-shell")
-        chroot("apt-get autoremove -y")
+        with transaction.environment():
+            chroot("apt-get remove --autoremove -y gnome-shell")
 
     # Fix gdm3, https://askubuntu.com/questions/1239503/ubuntu-20-04-and-20-10-etc-securetty-no-such-file-or-directory
     with contextlib.suppress(FileNotFoundError):
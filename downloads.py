@@ -0,0 +1,563 @@
+# Downloads for the build, replacing download_file of the vendored functions.py, which is overwritten by the
+# python-os-functions copy every night. Import them explicitly after "from functions import *".
+# Files are downloaded with multiple connections, resumed after failures and optionally kept in a persistent download
+# cache. Archives can be streamed into tar without saving them first.
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import ssl
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Empty, Queue
+from threading import Event, Lock
+from time import time
+from typing import Tuple
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+import functions
+from functions import *
+from commands import PhaseCancelled, check_cancelled, phases_cancelled
+from extract import pipefail, tar_command
+
+
+def download_and_extract(urls: list, archive_name: str, dest: str, strip_prefix: str = "",
+                         checksums: dict = None) -> None:
+    """
+    Stream an archive from the internet directly into tar, without saving it to disk first. Archives that are split into
+    multiple parts are streamed in order, as one archive. If the download cache is enabled, the parts are saved to the
+    cache while streaming and served from it in later calls.
+
+    :param urls: A list of strings representing the urls of all parts of the archive, in order.
+    :param archive_name: A string representing the name of the complete archive, used to determine the compression.
+    :param dest: A string representing the full destination directory where the extracted files will be extracted to.
+    :param strip_prefix: A string representing a directory inside the archive. Only its contents are extracted to dest.
+    :param checksums: A dict of url: sha256. Parts without a checksum are only verified by their size. A part that
+                      does not match stops the extraction with a ValueError.
+    :return: None
+    """
+    tar = subprocess.Popen(pipefail(tar_command(archive_name, dest, strip_prefix=strip_prefix)), shell=True,
+                           stdin=subprocess.PIPE)
+    try:
+        for url in urls:
+            _stream_url(url, tar.stdin, (checksums or {}).get(url, ""))
+        tar.stdin.close()
+    except BrokenPipeError:
+        pass  # tar exited early, its exit code is checked below
+    except BaseException as e:
+        tar.kill()
+        tar.wait()
+        raise e
+    if tar.wait() != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar.args)
+
+
+# write a file from the internet or the download cache into a pipe and verify its size and checksum, if one is given
+def _stream_url(url: str, pipe, checksum: str = "") -> None:
+    entry, etag, last_modified = _cache_lookup(url) if download_cache_dir else ({}, "", "")
+    if entry:
+        if checksum and entry["sha256"] != checksum:
+            raise ValueError(f"Checksum of {url} does not match")
+        blob = Path(f"{download_cache_dir}/blobs/{entry['sha256']}")
+        os.utime(blob)  # mark as recently used for the lru eviction
+        print_status(f"Using cached {url}")
+        with open(blob, "rb") as file:
+            shutil.copyfileobj(file, pipe, 1048576)
+        return
+
+    # tee the stream into the download cache
+    partial_file = Path(f"{download_cache_dir}/partial/{hashlib.sha256(url.encode()).hexdigest()}")
+    if download_cache_dir:
+        rmfile(f"{partial_file}.state")  # the file is rewritten from the start -> any old state is invalid
+    sha256 = hashlib.sha256()
+    position = [0]
+    progress = []
+
+    def stream() -> None:
+        # continue where the last attempt stopped
+        headers = {"Range": f"bytes={position[0]}-"} if position[0] else {}
+        with urlopen(Request(url, headers=headers), timeout=60) as response:
+            skip = position[0] if response.status != 206 else 0  # server ignored the range -> skip sent bytes
+            if not progress:
+                progress.append(_DownloadProgress(int(response.headers.get("Content-Length", 0))))
+            while chunk := response.read(1048576):
+                if skip:
+                    chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                check_cancelled()
+                pipe.write(chunk)
+                sha256.update(chunk)
+                if download_cache_dir:
+                    cache_file.write(chunk)
+                position[0] += len(chunk)
+                progress[0].update(len(chunk))
+            if position[0] < progress[0].total_size:
+                raise ConnectionError(f"connection closed at byte {position[0]}")
+
+    with open(partial_file, "wb") if download_cache_dir else contextlib.nullcontext() as cache_file:
+        try:
+            _retry_download(stream, f"Downloading {url}")
+        finally:
+            if progress:
+                progress[0].finish()
+    if progress[0].total_size and position[0] != progress[0].total_size:
+        raise ValueError(f"Size of {url} does not match, expected {progress[0].total_size} bytes")
+    if checksum and sha256.hexdigest() != checksum:
+        raise ValueError(f"Checksum of {url} does not match")
+    if download_cache_dir:
+        _cache_add(url, partial_file, sha256.hexdigest(), etag, last_modified)
+        _evict_download_cache()
+
+
+# A shared progress object can be passed if multiple files are downloaded at the same time
+def download_file(url: str, path: str, progress=None) -> None:
+    if download_cache_dir:  # serve the file from the persistent download cache if possible
+        _cached_download(url, path, progress)
+        return
+    _download(url, Path(path), progress=progress)
+
+
+def download_files(downloads: list, checksums: dict = None) -> None:
+    """
+    Download multiple files at the same time with a combined progress display and verify their sizes and checksums.
+
+    :param downloads: A list of (url, path) tuples. path is a string representing the full path to the downloaded file.
+    :param checksums: A dict of url: sha256. Files without a checksum are only verified by their size.
+    :return: None
+    """
+    if not downloads:
+        raise ValueError("No files to download")
+    sizes = [get_remote_file_size(url) for url, path in downloads]
+    progress = _DownloadProgress(sum(sizes))
+    executor = ThreadPoolExecutor(max_workers=len(downloads))
+    try:
+        futures = [executor.submit(download_file, url, path, progress) for url, path in downloads]
+        for future in as_completed(futures):
+            future.result()  # raise the first exception of the download threads
+    finally:
+        executor.shutdown(cancel_futures=True)  # do not start queued downloads after an error or Ctrl+C
+        progress.finish()
+
+    for (url, path), size in zip(downloads, sizes):
+        if Path(path).stat().st_size != size:
+            rmfile(path)
+            raise ValueError(f"Size of {url} does not match, expected {size} bytes")
+        if checksums and url in checksums:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as file:
+                while chunk := file.read(1048576):
+                    sha256.update(chunk)
+            if sha256.hexdigest() != checksums[url]:
+                rmfile(path)
+                raise ValueError(f"Checksum of {url} does not match")
+
+
+# get the size of a file on a server without downloading it
+def get_remote_file_size(url: str) -> int:
+    with urlopen(Request(url, headers={"Range": "bytes=0-0"}), timeout=60) as response:
+        if response.status == 206:
+            return int(response.headers["Content-Range"].split("/")[1])
+        return int(response.headers.get("Content-Length", 0))
+
+
+# Version of a file on a server, i.e. its ETag. Servers without ETags are compared by modification time and size.
+def get_remote_file_version(url: str) -> str:
+    with urlopen(Request(url, headers={"Range": "bytes=0-0"}), timeout=60) as response:
+        if response.headers.get("ETag"):
+            return response.headers["ETag"]
+        size = response.headers["Content-Range"].split("/")[1] if response.status == 206 else \
+            response.headers.get("Content-Length", "")
+        return f"{response.headers.get('Last-Modified', '')} {size}"
+
+
+# check if a file exists on a server without downloading it
+def url_exists(url: str) -> bool:
+    try:
+        with urlopen(Request(url, headers={"Range": "bytes=0-0"}), timeout=60):
+            return True
+    except HTTPError as e:
+        if e.code in [404, 410]:
+            return False
+        raise e
+
+
+def set_download_connections(connections: int) -> None:
+    global download_connections
+    download_connections = connections
+
+
+# Retry a network operation with exponential backoff. Other errors, i.e. a full disk, are raised right away.
+# check_stopped is called while waiting and raises an exception if the download should stop.
+def _retry_download(operation, description: str, check_stopped=check_cancelled):
+    for attempt in range(download_retries + 1):
+        try:
+            return operation()
+        except _network_errors as e:
+            # retrying won't help if the file doesn't exist or if the process reading a streamed download exited
+            if attempt == download_retries or (isinstance(e, HTTPError) and e.code in [404, 410]) or \
+                    isinstance(e, BrokenPipeError):
+                raise e
+            delay = 2 ** attempt
+            print_warning(f"\n{description} failed ({e}), retrying in {delay}s")
+            for _ in range(delay):  # wait in steps of a second, to stop early
+                check_stopped()
+                phases_cancelled.wait(1)
+            check_stopped()
+
+
+# Download a file with multiple connections if the server supports range requests.
+# Completed ranges are recorded in a <path>.state file, to be able to resume the download after a failure or in a
+# later run. Returns the sha256 of the file if hash_file is set.
+def _download(url: str, path: Path, hash_file: bool = False, progress=None) -> str:
+    # Ask for the first byte only, to find out the total size, the final url after redirects and range support
+    def probe():
+        return urlopen(Request(url, headers={"Range": "bytes=0-0"}), timeout=60)
+
+    response = _retry_download(probe, f"Connecting to {url}")
+    if response.status != 206 or response.headers.get("Accept-Ranges", "bytes") == "none":
+        # server ignored the range header and is already sending the whole file -> use it as a single stream
+        return _download_single_stream(url, response, path, hash_file, progress)
+    with response:
+        final_url = [response.url]  # signed urls (i.e. GitHub release assets) expire -> refreshed on errors
+        total_size = int(response.headers["Content-Range"].split("/")[1])
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+
+    # resume the download, if a previous attempt downloaded the same file version
+    state_file = Path(f"{path}.state")
+    state = {"url": url, "validator": validator, "size": total_size, "completed": []}
+    with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
+        with open(state_file, "r") as file:
+            old_state = json.load(file)
+        if path.exists() and all(old_state.get(key) == state[key] for key in ["url", "validator", "size"]):
+            state = old_state
+    completed_ranges = {start: end for start, end in state["completed"]}
+    if completed_ranges:
+        print_status(f"Resuming download of {url}")
+
+    resumed_size = sum(end - start for start, end in completed_ranges.items())
+    own_progress = progress is None
+    if own_progress:
+        progress = _DownloadProgress(total_size, resumed_size)
+    else:
+        progress.add_resumed(resumed_size)
+    sha256 = hashlib.sha256() if hash_file else None
+    hashed = [0]  # the file is hashed in order, up to the end of the first incomplete range
+    lock = Lock()
+    connection_pool = Queue()
+    stopped = Event()  # set if a range failed, to stop the other connections
+
+    def check_stopped() -> None:
+        check_cancelled()
+        if stopped.is_set():
+            raise PhaseCancelled("Download stopped, as another range failed")
+
+    # get a keep-alive connection for the current url from the pool or open a new one
+    def get_connection() -> Tuple[http.client.HTTPConnection, str]:
+        url_parts = urlsplit(final_url[0])
+        request_path = f"{url_parts.path}?{url_parts.query}" if url_parts.query else url_parts.path
+        with contextlib.suppress(Empty):
+            while True:
+                connection, netloc = connection_pool.get_nowait()
+                if netloc == url_parts.netloc:
+                    break
+                connection.close()  # connection to a previous host
+            return connection, request_path
+        if url_parts.scheme == "https":
+            connection = http.client.HTTPSConnection(url_parts.netloc, timeout=60)
+        else:
+            connection = http.client.HTTPConnection(url_parts.netloc, timeout=60)
+        return connection, request_path
+
+    def hash_completed_ranges() -> None:
+        # hash all ranges that are complete from the start of the file on
+        while hashed[0] in completed_ranges:
+            position, range_end = hashed[0], completed_ranges[hashed[0]]
+            while position < range_end:
+                chunk = os.pread(file_descriptor, min(1048576, range_end - position), position)
+                sha256.update(chunk)
+                position += len(chunk)
+            hashed[0] = range_end
+
+    def fetch_range(start: int, end: int) -> None:
+        offset = [start]  # bytes that were already written are not downloaded again on retries
+
+        def fetch() -> None:
+            connection, request_path = get_connection()
+            try:
+                connection.request("GET", request_path, headers={"Range": f"bytes={offset[0]}-{end}"})
+                range_response = connection.getresponse()
+                if range_response.status != 206:
+                    raise HTTPError(final_url[0], range_response.status, range_response.reason,
+                                    range_response.headers, None)
+                while chunk := range_response.read(1048576):
+                    check_stopped()
+                    os.pwrite(file_descriptor, chunk, offset[0])
+                    offset[0] += len(chunk)
+                    progress.update(len(chunk))
+                if offset[0] != end + 1:
+                    raise ConnectionError(f"connection closed at byte {offset[0]}")
+            except BaseException as e:
+                connection.close()  # do not return broken connections to the pool
+                if isinstance(e, _network_errors):
+                    with contextlib.suppress(OSError, http.client.HTTPException):
+                        with probe() as new_response:
+                            final_url[0] = new_response.url
+                raise e
+            connection_pool.put((connection, urlsplit(final_url[0]).netloc))
+
+        _retry_download(fetch, f"Downloading bytes {start}-{end}", check_stopped)
+        with lock:
+            completed_ranges[start] = end + 1
+            state["completed"] = list(completed_ranges.items())
+            with open(f"{state_file}.tmp", "w") as file:
+                json.dump(state, file)
+            Path(f"{state_file}.tmp").replace(state_file)
+            if hash_file:
+                hash_completed_ranges()
+
+    if not completed_ranges:
+        rmfile(path.as_posix())
+    file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not completed_ranges:
+            # preallocate the whole file to avoid fragmentation and to be able to write the ranges at their offsets
+            try:
+                os.posix_fallocate(file_descriptor, 0, total_size)
+            except OSError:  # not supported on all filesystems
+                os.ftruncate(file_descriptor, total_size)
+        elif hash_file:
+            hash_completed_ranges()  # hash the ranges from the previous attempt
+        ranges = [(start, min(start + download_range_size, total_size) - 1)
+                  for start in range(0, total_size, download_range_size) if start not in completed_ranges]
+        if functions.verbose:
+            print(f"Downloading {len(ranges)} ranges of {final_url[0]} with {download_connections} connections")
+        executor = ThreadPoolExecutor(max_workers=max(1, download_connections))
+        try:
+            futures = [executor.submit(fetch_range, start, end) for start, end in ranges]
+            for future in as_completed(futures):
+                future.result()  # raise the first exception of the download threads
+        except BaseException as e:  # including Ctrl+C
+            stopped.set()
+            raise e
+        finally:
+            # the running ranges have to stop before the file is closed, queued ranges are not started anymore
+            executor.shutdown(cancel_futures=True)
+    finally:
+        os.close(file_descriptor)
+        while not connection_pool.empty():
+            connection_pool.get_nowait()[0].close()
+        if own_progress:
+            progress.finish()
+    rmfile(state_file.as_posix())
+    return sha256.hexdigest() if hash_file else ""
+
+
+# Download a file from a server without range support. Failed attempts have to restart from the beginning.
+def _download_single_stream(url: str, response, path: Path, hash_file: bool, progress=None) -> str:
+    own_progress = progress is None
+    if own_progress:
+        progress = _DownloadProgress(int(response.headers.get("Content-Length", 0)))
+    first_response = [response]
+    written = [0]
+
+    def stream() -> str:
+        sha256 = hashlib.sha256()
+        progress.rewind(written[0])  # a failed attempt has to be downloaded again
+        written[0] = 0
+        with first_response.pop() if first_response else urlopen(url, timeout=60) as stream_response, \
+                open(path, "wb") as file:
+            while chunk := stream_response.read(1048576):
+                check_cancelled()
+                if hash_file:
+                    sha256.update(chunk)
+                file.write(chunk)
+                written[0] += len(chunk)
+                progress.update(len(chunk))
+        return sha256.hexdigest() if hash_file else ""
+
+    try:
+        return _retry_download(stream, f"Downloading {url}")
+    finally:
+        if own_progress:
+            progress.finish()
+
+
+# Prints the progress of a download, updated by the download loop with the amount of new bytes.
+# Output is limited to a few updates per second and disabled in non-interactive shells.
+class _DownloadProgress:
+    def __init__(self, total_size: int, already_downloaded: int = 0):
+        self.total_size = total_size
+        self.downloaded = already_downloaded
+        self.resumed_size = already_downloaded  # not included in the throughput
+        self.start_time = time()
+        self.last_print = 0.0
+        self.lock = Lock()
+
+    def update(self, size: int) -> None:
+        if no_download_progress:
+            return
+        with self.lock:
+            self.downloaded += size
+            now = time()
+            if now - self.last_print < 0.25:
+                return
+            self.last_print = now
+            self._print(now)
+
+    # add bytes that were downloaded before, i.e. by a previous run or served from a cache
+    def add_resumed(self, size: int) -> None:
+        with self.lock:
+            self.downloaded += size
+            self.resumed_size += size
+
+    # remove bytes that have to be downloaded again
+    def rewind(self, size: int) -> None:
+        with self.lock:
+            self.downloaded -= size
+
+    def finish(self) -> None:
+        if no_download_progress:
+            return
+        with self.lock:
+            self._print(time())
+        print("\n", end="")
+
+    def _print(self, now: float) -> None:
+        speed = (self.downloaded - self.resumed_size) / max(now - self.start_time, 0.001)
+        line = f"\rDownloading: {self.downloaded / 1048576:.0f}mb"
+        if self.total_size:
+            line += f" / {self.total_size / 1048576:.0f}mb"
+        line += f", {speed / 1048576:.1f}mb/s"
+        if self.total_size and speed:
+            eta = int((self.total_size - self.downloaded) / speed)
+            line += f", {eta // 60}:{eta % 60:02d} left"
+        print(line + "   ", end="", flush=True)  # spaces to overwrite leftovers of longer lines
+
+
+#######################################################################################
+#                                    DOWNLOAD CACHE                                   #
+#######################################################################################
+# Downloaded files are stored content-addressed in <cache dir>/blobs/<sha256>.
+# <cache dir>/index/<sha256 of url>.json maps an url to its blob and the ETag/Last-Modified validators of the server.
+# Partial downloads are kept in <cache dir>/partial until they are complete.
+
+def set_download_cache(cache_dir: str, max_size_gb: float = 20) -> None:
+    """
+    Enable the persistent download cache. An empty cache_dir disables the cache.
+
+    :param cache_dir: A string representing the full path to the cache directory. Should not be inside a scratch dir.
+    :param max_size_gb: Maximum size of all cached files in GB. The least recently used files are evicted first.
+    :return: None
+    """
+    global download_cache_dir, download_cache_max_size
+    download_cache_dir = cache_dir
+    download_cache_max_size = int(max_size_gb * 1073741824)
+    if cache_dir:
+        for sub_dir in ["blobs", "index", "partial"]:
+            mkdir(f"{cache_dir}/{sub_dir}", create_parents=True)
+
+
+def _cache_index_path(url: str) -> Path:
+    return Path(f"{download_cache_dir}/index/{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+
+def _read_cache_index(url: str) -> dict:
+    try:
+        with open(_cache_index_path(url), "r") as index_file:
+            entry = json.load(index_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    # the blob might have been evicted by another url pointing to the same content
+    if not path_exists(f"{download_cache_dir}/blobs/{entry['sha256']}"):
+        return {}
+    return entry
+
+
+# Check if the cached file of an url is still up to date.
+# Returns the cache entry, or an empty dict if the file has to be downloaded, and the current validators of the file.
+def _cache_lookup(url: str) -> Tuple[dict, str, str]:
+    entry = _read_cache_index(url)
+    # ask the server if the cached file is still up to date, only the first byte is requested in case it isn't
+    request = Request(url, headers={"Range": "bytes=0-0"})
+    if entry.get("etag"):
+        request.add_header("If-None-Match", entry["etag"])
+    if entry.get("last_modified"):
+        request.add_header("If-Modified-Since", entry["last_modified"])
+    try:
+        response = urlopen(request, timeout=60)
+    except HTTPError as e:
+        if e.code != 304 or not entry:
+            raise e
+        return entry, entry["etag"], entry["last_modified"]  # 304 Not Modified -> cached file is still valid
+
+    with response:
+        etag = response.headers.get("ETag", "")
+        last_modified = response.headers.get("Last-Modified", "")
+    # some servers ignore conditional requests -> compare validators manually
+    if not entry or not etag or etag != entry.get("etag"):
+        return {}, etag, last_modified
+    return entry, etag, last_modified
+
+
+def _cached_download(url: str, path: str, progress=None) -> None:
+    entry, etag, last_modified = _cache_lookup(url)
+    if not entry:
+        # download the file into the cache and hash it while downloading
+        partial_file = Path(f"{download_cache_dir}/partial/{hashlib.sha256(url.encode()).hexdigest()}")
+        file_hash = _download(url, partial_file, hash_file=True, progress=progress)
+        entry = _cache_add(url, partial_file, file_hash, etag, last_modified)
+    elif progress is not None:
+        progress.add_resumed(entry["size"])
+
+    blob = Path(f"{download_cache_dir}/blobs/{entry['sha256']}")
+    os.utime(blob)  # mark as recently used for the lru eviction
+    if functions.verbose:
+        print(f"Using cached {url} from {blob}")
+    # hardlink the blob if the cache is on the same filesystem as the destination, otherwise copy it
+    rmfile(path)
+    try:
+        os.link(blob, path)
+    except OSError:
+        shutil.copyfile(blob, path)
+    _evict_download_cache()
+
+
+# move a completely downloaded file into the cache
+def _cache_add(url: str, partial_file: Path, file_hash: str, etag: str, last_modified: str) -> dict:
+    entry = {"url": url, "etag": etag, "last_modified": last_modified, "sha256": file_hash,
+             "size": partial_file.stat().st_size}
+    partial_file.replace(f"{download_cache_dir}/blobs/{file_hash}")
+    with open(_cache_index_path(url), "w") as index_file:
+        json.dump(entry, index_file)
+    return entry
+
+
+# remove the least recently used blobs until the cache fits into the size limit
+def _evict_download_cache() -> None:
+    blobs = sorted(Path(f"{download_cache_dir}/blobs").iterdir(), key=lambda blob: blob.stat().st_mtime)
+    cache_size = sum(blob.stat().st_size for blob in blobs)
+    # never evict the most recently used blob, i.e. the one that was just requested
+    for blob in blobs[:-1]:
+        if cache_size <= download_cache_max_size:
+            break
+        print_status(f"Evicting {blob.name} from download cache")
+        cache_size -= blob.stat().st_size
+        rmfile(blob.as_posix())
+    # remove index entries pointing to evicted blobs
+    for index in Path(f"{download_cache_dir}/index").iterdir():
+        with contextlib.suppress(FileNotFoundError, json.JSONDecodeError, KeyError):
+            with open(index, "r") as index_file:
+                if not path_exists(f"{download_cache_dir}/blobs/{json.load(index_file)['sha256']}"):
+                    rmfile(index.as_posix())
+
+
+download_connections = 8  # amount of parallel connections per download
+download_range_size = 33554432  # 32mb per range request
+download_retries = 6  # failed requests are retried after 1, 2, 4, 8, 16 and 32 seconds
+download_cache_dir = ""  # persistent download cache is disabled by default
+download_cache_max_size = 0
+# errors that are worth retrying a download for. URLError includes HTTPError, timeouts are TimeoutErrors
+_network_errors = (URLError, http.client.HTTPException, ConnectionError, TimeoutError, ssl.SSLError)
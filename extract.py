@@ -0,0 +1,98 @@
+# Archive extraction, replacing extract_file of the vendored functions.py, which is overwritten by the
+# python-os-functions copy every night. Import it explicitly after "from functions import *".
+# Archives are decompressed outside of tar, by the fastest available decompressor for their format.
+import os
+import shlex
+import subprocess
+
+from functions import *
+from commands import bash
+
+
+def extract_file(file: str, dest: str, strip_prefix: str = "", parts: list = None) -> None:
+    """
+    Extract a compressed file using tar and use pv to show progress if pv is installed.
+
+    :param file: A string representing the full path to the compressed file to be extracted.
+    :param dest: A string representing the full destination directory where the extracted files will be extracted to.
+    :param strip_prefix: A string representing a directory inside the archive. Only its contents are extracted to dest.
+    :param parts: A list of strings representing the full paths to the parts of a split archive, in order. The parts
+                  are read as one stream and extracted as the archive named file, without combining them on disk.
+    :return: None
+    """
+    if parts:
+        if no_extract_progress:  # for non-interactive shells only
+            bash(pipefail(f"cat {' '.join(parts)} | {tar_command(file, dest, strip_prefix=strip_prefix)}"))
+            return
+        bash(pipefail(f"pv {' '.join(parts)} | {tar_command(file, dest, strip_prefix=strip_prefix)}"))
+        return
+    if no_extract_progress:  # for non-interactive shells only
+        bash(pipefail(tar_command(file, dest, source=file, strip_prefix=strip_prefix)))
+        return
+    bash(pipefail(f"pv {file} | {tar_command(file, dest, strip_prefix=strip_prefix)}"))
+
+
+def set_decompress_threads(threads: int) -> None:
+    global decompress_threads
+    decompress_threads = threads
+
+
+# tar command to extract an archive from stdin or from a file, the compression is determined by the name of the archive
+# The archive is decompressed by the fastest available decompressor, outside of tar
+# If strip_prefix is set, only that directory is extracted and the prefix is removed from the extracted paths
+def tar_command(archive_name: str, dest: str, source: str = "", strip_prefix: str = "") -> str:
+    decompressor = f"{_decompressor(archive_name)} < {source}" if source else _decompressor(archive_name)
+    # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
+    tar_command = f"tar xfp - --warning=no-unknown-keyword -C {dest}"
+    if strip_prefix:
+        strip_prefix = strip_prefix.strip("/")
+        tar_command += f" --strip-components={strip_prefix.count('/') + 1} {strip_prefix}"
+    return f"{decompressor} | {tar_command}"
+
+
+# Command to run a pipeline in bash with pipefail, so that it also fails if a command before the last one fails.
+# Otherwise only the exit status of tar is checked and i.e. a checksum error of the decompressor goes unnoticed.
+def pipefail(pipeline: str) -> str:
+    return f"/bin/bash -o pipefail -c {shlex.quote(pipeline)}"
+
+
+# command to decompress stdin to stdout with as many threads as the format allows
+def _decompressor(archive_name: str) -> str:
+    threads = decompress_threads or os.cpu_count() or 1
+    if archive_name.endswith(".gz"):
+        # gzip can't be decompressed in parallel, but pigz moves reading, writing and checksums into separate threads
+        if _tool_available("pigz"):
+            return f"pigz -dc -p {threads}"
+        return "gzip -dc"
+    if archive_name.endswith(".xz"):
+        # xz >= 5.4 decompresses multi-block archives in parallel
+        xz_version = bash("xz --version").split("\n")[0].split(" ")[-1]
+        if tuple(int(number) for number in xz_version.split(".")[:2]) >= (5, 4):
+            return f"xz -dc -T {decompress_threads}"  # 0 = one thread per core
+        if _tool_available("pixz"):
+            return f"pixz -d -p {threads}"
+        return "xz -dc"
+    if archive_name.endswith(".zst"):
+        # pzstd decompresses archives created by pzstd/zstd -T in parallel
+        if _tool_available("pzstd"):
+            return f"pzstd -dc -p {threads}"
+        return "zstd -dc"
+    raise ValueError(f"Unsupported archive format: {archive_name}")
+
+
+def zstd_available() -> bool:
+    return _tool_available("zstd") or _tool_available("pzstd")
+
+
+def _tool_available(tool: str) -> bool:
+    if tool not in available_tools:
+        try:
+            bash(f"which {tool} > /dev/null 2>&1")
+            available_tools[tool] = True
+        except subprocess.CalledProcessError:
+            available_tools[tool] = False
+    return available_tools[tool]
+
+
+decompress_threads = 0  # 0 = use all cores
+available_tools = {}  # cache for _tool_available
@@ -0,0 +1,204 @@
+# Fast replacements for the file functions of the vendored functions.py, which is overwritten by the python-os-functions
+# copy every night. Import them explicitly after "from functions import *" to override the simple versions.
+# Copies preserve all metadata, use reflinks where possible and, like removals, run in multiple threads.
+import contextlib
+import fcntl
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IMODE, S_ISLNK
+from threading import Lock
+from time import time
+
+import functions
+from functions import *
+
+copy_threads = 16  # copying is mostly limited by I/O latency -> use more threads than cores
+
+
+# unlink all files in a directory and remove the directory
+# The top level subdirectories are removed in parallel. Symlinks are not followed and filesystems that are mounted
+# inside the directory are left untouched.
+def rmdir(rm_dir: str, keep_dir: bool = True) -> None:
+    removed = {"files": 0, "bytes": 0}
+    lock = Lock()
+
+    # unlink all files in an open dir and return the names of its subdirs
+    def unlink_files(dir_fd: int) -> list:
+        subdirs = []
+        files = bytes_freed = 0
+        with os.scandir(dir_fd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                bytes_freed += entry.stat(follow_symlinks=False).st_size
+                os.unlink(entry.name, dir_fd=dir_fd)
+                files += 1
+        with lock:
+            removed["files"] += files
+            removed["bytes"] += bytes_freed
+        return subdirs
+
+    # remove a dir relative to its open parent dir, returns False if something had to be left behind
+    # Walks the tree with a stack instead of recursion, as python has a recursion limit
+    def remove_tree(parent_fd: int, name: str) -> bool:
+        stack = []  # [dir fd, name, remaining subdirs, fully removed]
+
+        def enter(dir_parent_fd: int, dir_name: str) -> bool:
+            dir_fd = os.open(dir_name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_parent_fd)
+            if os.fstat(dir_fd).st_dev != root_device:
+                print(f"Not removing {dir_name}, as it is a mount point")
+                os.close(dir_fd)
+                return False
+            stack.append([dir_fd, dir_name, unlink_files(dir_fd), True])
+            return True
+
+        if not enter(parent_fd, name):
+            return False
+        while True:
+            frame = stack[-1]
+            if frame[2]:
+                if not enter(frame[0], frame[2].pop()):
+                    frame[3] = False
+                continue
+            stack.pop()
+            os.close(frame[0])
+            frame_parent_fd = stack[-1][0] if stack else parent_fd
+            if frame[3]:
+                os.rmdir(frame[1], dir_fd=frame_parent_fd)
+            elif stack:
+                stack[-1][3] = False
+            if not stack:
+                return frame[3]
+
+    try:
+        root_fd = os.open(rm_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        print(f"Couldn't remove non existent directory: {rm_dir}, ignoring")
+        return
+    try:
+        root_device = os.fstat(root_fd).st_dev
+        subdirs = unlink_files(root_fd)
+        with ThreadPoolExecutor(max_workers=copy_threads) as executor:
+            fully_removed = all(list(executor.map(lambda subdir: remove_tree(root_fd, subdir), subdirs)))
+    finally:
+        os.close(root_fd)
+    if functions.verbose or removed["files"]:
+        print(f"Removed {removed['files']} files ({removed['bytes'] / 1048576:.0f}mb) from {rm_dir}", flush=True)
+    # Remove emtpy directory
+    if not keep_dir and fully_removed:
+        Path(rm_dir).rmdir()
+
+
+# recursively copy files from a dir into another dir
+# Preserves ownership, modes, timestamps, xattrs (i.e. SELinux labels), symlinks, hardlinks and device nodes
+def cpdir(src_as_str: str, dst_as_string: str) -> None:  # dst_dir must be a full path, including the new dir name
+    src_as_path = Path(src_as_str)
+    dst_as_path = Path(dst_as_string)
+    if not src_as_path.is_dir():
+        raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
+    if not dst_as_path.exists():
+        mkdir(dst_as_string)
+
+    start_time = time()
+    copied = {"files": 0, "bytes": 0}
+    lock = Lock()
+    hardlinks = {}  # (device, inode) -> first copied path
+    pending_hardlinks = []  # (existing file in dst, new hardlink), created after all files were copied
+    dirs = []  # (src, dst, stat), metadata is applied after the contents were copied
+
+    def copy_file(src: str, dst: str, stat: os.stat_result) -> None:
+        _copy_file_data(src, dst)
+        _copy_metadata(src, dst, stat)
+        with lock:
+            copied["files"] += 1
+            copied["bytes"] += stat.st_size
+
+    with ThreadPoolExecutor(max_workers=copy_threads) as executor:
+        futures = []
+        stack = [(src_as_path.absolute().as_posix(), dst_as_path.absolute().as_posix())]
+        while stack:
+            src_dir, dst_dir = stack.pop()
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    dst = f"{dst_dir}/{entry.name}"
+                    stat = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        with contextlib.suppress(FileExistsError):
+                            os.mkdir(dst, 0o700)  # the real mode is set once the dir is filled
+                        dirs.append((entry.path, dst, stat))
+                        stack.append((entry.path, dst))
+                        continue
+                    if stat.st_nlink > 1 and not entry.is_symlink():
+                        if (stat.st_dev, stat.st_ino) in hardlinks:
+                            pending_hardlinks.append((hardlinks[(stat.st_dev, stat.st_ino)], dst))
+                            continue
+                        hardlinks[(stat.st_dev, stat.st_ino)] = dst
+                    if entry.is_file(follow_symlinks=False):
+                        futures.append(executor.submit(copy_file, entry.path, dst, stat))
+                        continue
+                    # symlinks, device nodes, fifos and sockets are recreated instead of copied
+                    rmfile(dst)
+                    if entry.is_symlink():
+                        os.symlink(os.readlink(entry.path), dst)
+                    else:
+                        os.mknod(dst, stat.st_mode, stat.st_rdev)
+                    _copy_metadata(entry.path, dst, stat)
+        for future in futures:
+            future.result()  # raise exceptions from the copy threads
+
+    for existing_file, new_link in pending_hardlinks:
+        rmfile(new_link)
+        os.link(existing_file, new_link)
+    # apply dir metadata in reverse order, so that parent dir timestamps are not changed by their children anymore
+    for src, dst, stat in reversed(dirs):
+        _copy_metadata(src, dst, stat)
+
+    elapsed_time = max(time() - start_time, 0.001)
+    print(f"Copied {copied['files']} files ({copied['bytes'] / 1048576:.0f}mb) in {elapsed_time:.1f}s, "
+          f"{copied['bytes'] / 1048576 / elapsed_time:.1f}mb/s", flush=True)
+
+
+def cpfile(src_as_str: str, dst_as_str: str) -> None:  # "/etc/resolv.conf", "/var/some_config/resolv.conf"
+    src_as_path = Path(src_as_str)
+    dst_as_path = Path(dst_as_str)
+    if functions.verbose:
+        print(f"Copying {src_as_path.absolute().as_posix()} to {dst_as_path.absolute().as_posix()}")
+    if src_as_path.exists():
+        _copy_file_data(src_as_path.as_posix(), dst_as_path.as_posix())
+    else:
+        raise FileNotFoundError(f"No such file: {src_as_path.absolute().as_posix()}")
+
+
+# copy the contents of a file without reading it into memory
+# reflinks are used if the filesystem supports them, otherwise the kernel copies the data with copy_file_range
+def _copy_file_data(src: str, dst: str) -> None:
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        with contextlib.suppress(OSError):
+            fcntl.ioctl(dst_file.fileno(), 0x40049409, src_file.fileno())  # FICLONE
+            return
+        try:
+            while os.copy_file_range(src_file.fileno(), dst_file.fileno(), 1073741824):
+                pass
+        except OSError:  # not supported across some filesystems (i.e. into/from tmpfs on older kernels)
+            src_file.seek(0)
+            dst_file.seek(0)
+            dst_file.truncate()
+            shutil.copyfileobj(src_file, dst_file, 1048576)
+
+
+# copy ownership, mode, xattrs and timestamps
+def _copy_metadata(src: str, dst: str, stat: os.stat_result) -> None:
+    is_symlink = S_ISLNK(stat.st_mode)
+    os.chown(dst, stat.st_uid, stat.st_gid, follow_symlinks=False)
+    if not is_symlink:  # the mode of symlinks can't be changed on linux
+        os.chmod(dst, S_IMODE(stat.st_mode))  # after chown, as chown clears the setuid bit
+    with contextlib.suppress(OSError):  # xattrs are not supported on all filesystems
+        for name in os.listxattr(src, follow_symlinks=False):
+            try:
+                os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+            except OSError as e:
+                if functions.verbose:
+                    print(f"Couldn't copy xattr {name} of {src}: {e}")
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns), follow_symlinks=False)
@@ -0,0 +1,107 @@
+# Cache for the base system of a distro, i.e. the rootfs after everything up to the desktop environment was installed.
+# Builds of the same distro, version and kernel with a different desktop environment start from a copy of this layer,
+# instead of extracting the rootfs and installing the base packages again.
+# Layers are stored as plain directories in <cache dir>/<distro>-<version>-<kernel>-<input hash>. Copies use reflinks
+# if the cache and the image are on the same filesystem.
+# Layers are first copied to <layer>.partial, which is locked with <layer>.partial.lock while it is written, as
+# multiple builds can use the cache at the same time. The empty lock files are kept, as removing them would race with
+# builds that are about to lock them.
+import fcntl
+import hashlib
+import os
+from time import time
+
+from functions import *
+from fileops import cpdir, rmdir
+
+layer_cache_dir = ""  # empty = cache disabled
+layer_cache_max_age = 0  # in seconds
+
+# files that change the base layer, if they are modified
+layer_inputs = ["build.py", "commands.py", "extract.py", "fileops.py", "functions.py", "mirrors.py", "package_cache.py",
+                "progress.py", "transaction.py", "configs/hwdb/61-sensor.hwdb"]
+# files that have to be unique per image and are recreated by config_restored_base of the distro
+per_image_files = ["etc/pacman.d/gnupg"]  # the private master key of the pacman keyring
+
+
+def set_layer_cache(cache_dir: str, max_age_hours: float = 24) -> None:
+    """
+    Enable the base layer cache. An empty cache_dir disables the cache.
+
+    :param cache_dir: A string representing the full path to the cache directory. Should not be inside a scratch dir.
+    :param max_age_hours: Layers older than this are rebuilt, as their packages and repo metadata get outdated.
+    :return: None
+    """
+    global layer_cache_dir, layer_cache_max_age
+    layer_cache_dir = cache_dir
+    layer_cache_max_age = int(max_age_hours * 3600)
+    if cache_dir:
+        mkdir(cache_dir, create_parents=True)
+
+
+# Name of the base layer of a build, changes whenever an input of the base layer or the rootfs changes
+def base_layer_name(distro_name: str, distro_version: str, kernel_type: str, rootfs_version: str) -> str:
+    inputs_hash = hashlib.sha256(f"{distro_name} {distro_version} {kernel_type} {rootfs_version}".encode())
+    for input_file in layer_inputs + [f"distro/{distro_name.replace('-', '_')}.py"]:
+        with open(input_file, "rb") as file:
+            inputs_hash.update(file.read())
+    return f"{distro_name}-{distro_version}-{kernel_type}-{inputs_hash.hexdigest()[:16]}"
+
+
+# Check if there is an up-to-date base layer for a build
+def base_layer_available(layer_name: str) -> bool:
+    if not layer_cache_dir:
+        return False
+    _evict_layers()
+    return path_exists(f"{layer_cache_dir}/{layer_name}")
+
+
+# Copy a cached base layer into the mounted rootfs
+def restore_base_layer(layer_name: str) -> None:
+    print_status(f"Restoring base layer {layer_name}")
+    cpdir(f"{layer_cache_dir}/{layer_name}", "/mnt/depthboot")
+
+
+# Save the mounted rootfs as base layer. Nothing may be mounted inside /mnt/depthboot.
+def save_base_layer(layer_name: str) -> None:
+    if not layer_cache_dir:
+        return
+    with open(f"{layer_cache_dir}/{layer_name}.partial.lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print_status(f"Base layer {layer_name} is already being saved by another build")
+            return
+        print_status(f"Saving base layer {layer_name}")
+        # copy to a temporary dir first, to never leave an incomplete layer behind
+        if path_exists(f"{layer_cache_dir}/{layer_name}.partial"):
+            rmdir(f"{layer_cache_dir}/{layer_name}.partial", keep_dir=False)
+        cpdir("/mnt/depthboot", f"{layer_cache_dir}/{layer_name}.partial")
+        for per_image_file in per_image_files:
+            if path_exists(f"{layer_cache_dir}/{layer_name}.partial/{per_image_file}"):
+                rmdir(f"{layer_cache_dir}/{layer_name}.partial/{per_image_file}", keep_dir=False)
+        # layers of the same distro, version and kernel with outdated inputs are never used again
+        build_name = layer_name[:layer_name.rfind("-")]
+        for old_layer in Path(layer_cache_dir).iterdir():
+            if old_layer.name.rsplit("-", 1)[0] == build_name and not old_layer.name.endswith((".partial", ".lock")):
+                rmdir(old_layer.as_posix(), keep_dir=False)
+        os.rename(f"{layer_cache_dir}/{layer_name}.partial", f"{layer_cache_dir}/{layer_name}")
+
+
+def _evict_layers() -> None:
+    for layer in Path(layer_cache_dir).iterdir():
+        if layer.name.endswith(".lock"):
+            continue
+        if layer.name.endswith(".partial"):
+            # only remove partial layers of builds that were interrupted, not the ones that are still being copied
+            with open(f"{layer}.lock", "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                print_status(f"Removing incomplete base layer {layer.name}")
+                rmdir(layer.as_posix(), keep_dir=False)
+            continue
+        if time() - layer.stat().st_mtime > layer_cache_max_age:
+            print_status(f"Removing outdated base layer {layer.name}")
+            rmdir(layer.as_posix(), keep_dir=False)
@@ -7,6 +7,7 @@ import os
 import sys
 
 from functions import *
+from fileops import rmdir
 
 global user_cancelled
 user_cancelled = False
@@ -25,6 +26,12 @@ def process_args():
                         help="Show device selection menu instead of automatically building image")
     parser.add_argument("-v", "--verbose", dest="verbose", help="Print more output", action="store_true")
     parser.add_argument("--no-shrink", dest="no_shrink", help="Do not shrink image", action="store_true")
+    parser.add_argument("--fast-io", dest="fast_io", action="store_true",
+                        help="Speed up writing to slow USB-drives/SD-cards by disabling the filesystem journal and "
+                             "package manager syncs until the end of the build. An interrupted build has to be redone")
+    parser.add_argument("--trace", dest="trace", action="store_true",
+                        help="Record every command of the build and write them to depthboot-trace.json in the Chrome "
+                             "trace event format")
     parser.add_argument("--no-deps-check", dest="no_deps_check", help="Do not check if dependencies are installed",
                         action="store_true")
     parser.add_argument("--verbose-kernel", dest="verbose_kernel", action="store_true",
@@ -36,6 +43,33 @@ def process_args():
     parser.add_argument("--dev", dest="dev_build", action="store_true", help="Use latest dev build. May be unstable.")
     parser.add_argument("--skip-commit-check", dest="skip_commit_check", action="store_true",
                         help="Do not check if local commit hash matches remote commit hash")
+    parser.add_argument("--download-cache", dest="download_cache", nargs="?", const="/var/cache/depthboot/downloads",
+                        help="Keep downloaded rootfs archives in a persistent cache and reuse them in later builds "
+                             "(default: /var/cache/depthboot/downloads)")
+    parser.add_argument("--download-cache-size", dest="download_cache_size", type=int, default=20,
+                        help="Maximum size of the download cache in GB, least recently used files are removed first "
+                             "(default: 20GB)")
+    parser.add_argument("--package-cache", dest="package_cache", nargs="?", const="/var/cache/depthboot/packages",
+                        help="Keep packages downloaded by the distro package manager in a persistent cache and reuse "
+                             "them in later builds (default: /var/cache/depthboot/packages)")
+    parser.add_argument("--package-cache-age", dest="package_cache_age", type=int, default=30,
+                        help="Remove cached packages that were not used for this many days (default: 30)")
+    parser.add_argument("--package-cache-size", dest="package_cache_size", type=int, default=20,
+                        help="Maximum size of the package cache per distro version in GB (default: 20GB)")
+    parser.add_argument("--metadata-cache-age", dest="metadata_cache_age", type=float, default=6,
+                        help="Reuse repository metadata from the package cache if it is younger than this many hours,"
+                             " instead of refreshing it. 0 always refreshes (default: 6)")
+    parser.add_argument("--layer-cache", dest="layer_cache", nargs="?", const="/var/cache/depthboot/layers",
+                        help="Save the base system of a distro and reuse it for builds with another desktop "
+                             "environment (default: /var/cache/depthboot/layers)")
+    parser.add_argument("--layer-cache-age", dest="layer_cache_age", type=float, default=24,
+                        help="Rebuild cached base systems that are older than this many hours (default: 24)")
+    parser.add_argument("--download-connections", dest="download_connections", type=int, default=8,
+                        help="Amount of parallel connections used to download the rootfs (default: 8)")
+    parser.add_argument("--stream", dest="stream_rootfs", action="store_true",
+                        help="Extract the rootfs while downloading it, instead of saving the archive to /tmp first")
+    parser.add_argument("--decompress-threads", dest="decompress_threads", type=int, default=0,
+                        help="Amount of threads used to decompress the rootfs (default: 0, one per cpu core)")
     return parser.parse_args()
 
 
@@ -222,6 +256,18 @@ if __name__ == "__main__":
         print_warning("Using local files")
     if args.verbose:
         print_warning("Verbosity increased")
+    if args.stream_rootfs:
+        print_warning("Rootfs will be extracted while downloading")
+    if args.download_cache:
+        print_warning(f"Using download cache at {args.download_cache}")
+    if args.package_cache:
+        print_warning(f"Using package cache at {args.package_cache}")
+    if args.layer_cache:
+        print_warning(f"Using base layer cache at {args.layer_cache}")
+    if args.fast_io:
+        print_warning("Fast io mode enabled, the filesystem is only synced at the end of the build")
+    if args.trace:
+        print_warning("Commands will be traced to depthboot-trace.json")
     if args.no_shrink:
         print_warning("Image will not be shrunk")
     if args.image_size[0] != 10:
@@ -240,7 +286,15 @@ if __name__ == "__main__":
     print_status("Removing old depthboot build files")
     with contextlib.suppress(subprocess.CalledProcessError):
         bash("umount -lR /tmp/depthboot-build/*")  # get rid of any mounts from previous generic iso builds
-    rmdir("/tmp/depthboot-build")
+    # keep partially downloaded files (the ones with a .state file) for the download to be resumed
+    with contextlib.suppress(FileNotFoundError):
+        for file in Path("/tmp/depthboot-build").iterdir():
+            if path_exists(f"{file}.state") or (file.suffix == ".state" and path_exists(file.as_posix()[:-6])):
+                continue
+            if file.is_dir() and not file.is_symlink():
+                rmdir(file.as_posix(), keep_dir=False)
+            else:
+                rmfile(file.as_posix())
 
     print_status("Unmounting old depthboot mounts if present")
     try:
@@ -253,14 +307,15 @@ if __name__ == "__main__":
 
     rmfile("depthboot.img")
     rmfile("kernel.flags")
-    rmfile(".stop_download_progress")
 
     # Check if there is enough space in /tmp
     avail_space = int(bash("BLOCK_SIZE=m df --output=avail /tmp").split("\n")[1][:-1])  # read tmp size in MB
     # TODO: Check if there is enough space on the device to build the image
     restore_tmp = False
 
-    if user_input["device"] == "image" and avail_space < 13000 and not args.skip_size_check:
+    # a streamed rootfs is not saved to /tmp
+    if user_input["device"] == "image" and avail_space < 13000 and not args.skip_size_check and \
+            not (args.stream_rootfs and user_input["distro_name"] != "generic"):
         print_warning("Not enough space in /tmp to build image. At least 13GB is required")
         # check if /tmp is a tmpfs mount
         if bash("df --output=fstype /tmp").__contains__("tmpfs"):
@@ -0,0 +1,52 @@
+# Mirror selection for the package managers inside the chroot.
+# All candidates are probed concurrently for their latency. The fastest of them then download a small repo file one
+# after another, so that they don't share the bandwidth, and are ranked by the time that took.
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from urllib.request import Request
+
+from functions import *
+
+
+def rank_mirrors(mirrors: list, probe_url, count: int = 5) -> list:
+    """
+    Find the fastest mirrors for the build host.
+
+    :param mirrors: A list of mirror urls.
+    :param probe_url: A function that returns the url of a small file in the repo of a mirror.
+    :param count: Maximum amount of mirrors to return.
+    :return: The fastest reachable mirrors, fastest first. Empty if no mirror could be reached.
+    """
+    print_status(f"Probing {len(mirrors)} mirrors")
+
+    def latency(mirror: str) -> float:
+        start_time = time()
+        try:
+            with urlopen(Request(probe_url(mirror), method="HEAD"), timeout=mirror_probe_timeout):
+                return time() - start_time
+        except (OSError, http.client.HTTPException):  # HTTPError and timeouts are OSErrors
+            return float("inf")
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        latencies = dict(zip(mirrors, executor.map(latency, mirrors)))
+    candidates = sorted((mirror for mirror in mirrors if latencies[mirror] != float("inf")), key=latencies.get)
+
+    download_times = {}
+    throughputs = {}
+    for mirror in candidates[:count * 3]:
+        start_time = time()
+        try:
+            with urlopen(probe_url(mirror), timeout=mirror_probe_timeout) as response:
+                size = len(response.read(4194304))
+        except (OSError, http.client.HTTPException):
+            continue
+        download_times[mirror] = time() - start_time
+        throughputs[mirror] = size / 1048576 / download_times[mirror]
+    ranked = sorted(download_times, key=download_times.get)[:count]
+    for mirror in ranked:
+        print(f"{mirror}: {latencies[mirror] * 1000:.0f}ms latency, {throughputs[mirror]:.1f}mb/s", flush=True)
+    return ranked
+
+
+mirror_probe_timeout = 3  # in seconds
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# Persistent host side cache for the packages downloaded by the package managers inside the chroot.
+# The cache is kept per distro + version in <cache dir>/<distro>-<version> and bind mounted over the package cache
+# directory of the chroot while the distro is configured. It is unmounted before the build cleans /var/cache, so
+# cached packages never end up in the image.
+# Repository metadata (apt lists, pacman sync dbs) is cached in <cache dir>/<distro>-<version>-metadata and copied
+# into the chroot, as the image should ship with the same metadata as an uncached build. dnf keeps its metadata in
+# /var/cache/dnf, which is already covered by the package cache mount.
+import hashlib
+import json
+import os
+from time import time
+
+from functions import *
+from commands import bash
+from fileops import cpdir, rmdir
+
+package_cache_dir = ""  # empty = cache disabled
+package_cache_max_age = 0  # in seconds
+package_cache_max_size = 0  # in bytes
+package_cache_mount = ""  # chroot path the cache is currently mounted on
+package_cache_configs = []  # config files created/modified to keep downloaded packages, restored on unmount
+package_cache_distro = ""  # distro name of the mounted cache
+package_cache_name = ""  # <distro>-<version>, name of the cache dirs of the mounted cache
+metadata_max_age = 0  # in seconds, 0 = metadata is always refreshed
+metadata_state = {}  # freshness stamp of the mounted metadata: {"updated": timestamp, "sources": hash}
+
+# package cache directory of each distro's package manager
+package_cache_paths = {
+    "ubuntu": "/var/cache/apt/archives",
+    "pop-os": "/var/cache/apt/archives",
+    "arch": "/var/cache/pacman/pkg",
+    "fedora": "/var/cache/dnf"
+}
+# repository metadata directories that are not part of the package cache dir
+metadata_paths = {
+    "ubuntu": "/var/lib/apt/lists",
+    "pop-os": "/var/lib/apt/lists",
+    "arch": "/var/lib/pacman/sync"
+}
+# configs that define which repositories the metadata belongs to
+metadata_sources = {
+    "ubuntu": ["/etc/apt/sources.list", "/etc/apt/sources.list.d"],
+    "pop-os": ["/etc/apt/sources.list", "/etc/apt/sources.list.d"],
+    # the build uses temporary pacman configs with the fastest mirrors of the host, the backups are the image's configs
+    "arch": ["/etc/pacman.conf.bak", "/etc/pacman.d/mirrorlist.bak"],
+    "fedora": ["/etc/yum.repos.d"]
+}
+
+
+def set_package_cache(cache_dir: str, max_age_days: int = 30, max_size_gb: float = 20,
+                      metadata_age_hours: float = 0) -> None:
+    """
+    Enable the persistent package cache. An empty cache_dir disables the cache.
+
+    :param cache_dir: A string representing the full path to the cache directory. Should not be inside a scratch dir.
+    :param max_age_days: Packages that were not used by a build for this many days are removed.
+    :param max_size_gb: Maximum size of the cache of a single distro version in GB. Oldest packages are removed first.
+    :param metadata_age_hours: Cached repository metadata younger than this is used without refreshing it.
+    :return: None
+    """
+    global package_cache_dir, package_cache_max_age, package_cache_max_size, metadata_max_age
+    package_cache_dir = cache_dir
+    package_cache_max_age = max_age_days * 86400
+    package_cache_max_size = int(max_size_gb * 1073741824)
+    metadata_max_age = int(metadata_age_hours * 3600)
+    if cache_dir:
+        mkdir(cache_dir, create_parents=True)
+
+
+# Bind mount the host cache of a distro version over the package cache directory of the chroot
+def mount_package_cache(distro_name: str, distro_version: str) -> None:
+    global package_cache_mount, package_cache_distro, package_cache_name
+    if not package_cache_dir or distro_name not in package_cache_paths:
+        return
+    package_cache_distro = distro_name
+    package_cache_name = f"{distro_name}-{distro_version}"
+    host_dir = f"{package_cache_dir}/{package_cache_name}"
+    chroot_dir = package_cache_paths[distro_name]
+    print_status(f"Mounting package cache {host_dir}")
+    mkdir(host_dir, create_parents=True)
+    prune_package_cache(host_dir)
+    if distro_name in ["ubuntu", "pop-os"]:
+        mkdir(f"{host_dir}/partial")  # apt refuses to download packages without it
+    mkdir(f"/mnt/depthboot{chroot_dir}", create_parents=True)
+    bash(f"mount --bind {host_dir} /mnt/depthboot{chroot_dir}")
+    package_cache_mount = chroot_dir
+    _keep_downloaded_packages(distro_name)
+    _restore_metadata(distro_name)
+
+
+# Unmount the package cache and restore the package manager configs. Needs to be called before /var/cache is cleaned.
+def umount_package_cache() -> None:
+    global package_cache_mount
+    if not package_cache_mount:
+        return
+    _save_metadata(package_cache_distro)
+    print_status("Unmounting package cache")
+    # mounted packages are not part of the image -> unmount first, even if restoring the configs fails
+    bash(f"umount /mnt/depthboot{package_cache_mount}")
+    package_cache_mount = ""
+    for config_file, original in package_cache_configs:
+        if original is None:
+            rmfile(config_file)
+        elif config_file.endswith("dnf.conf"):
+            # the distro config might have replaced dnf.conf -> only remove the added line
+            with open(config_file, "r") as f:
+                config = f.read()
+            with open(config_file, "w") as f:
+                f.write(config.replace(original, ""))
+        else:
+            bash(f"mv {original} {config_file}")
+    package_cache_configs.clear()
+
+
+# Remove packages that were not used for longer than the max age, then the least recently used packages until the
+# cache is smaller than the max size. A package counts as used when it was downloaded or read by the package manager.
+def prune_package_cache(host_dir: str) -> None:
+    packages = [file for file in Path(host_dir).rglob("*") if file.is_file()]
+    packages.sort(key=_last_used)
+    cache_size = sum(package.stat().st_size for package in packages)
+    removed = freed = 0
+    for package in packages:
+        package_stat = package.stat()
+        if time() - _last_used(package) <= package_cache_max_age and cache_size <= package_cache_max_size:
+            break
+        cache_size -= package_stat.st_size
+        freed += package_stat.st_size
+        removed += 1
+        rmfile(package.as_posix())
+    if removed:
+        print_status(f"Removed {removed} packages ({freed // 1048576}mb) from package cache")
+
+
+# Check if the repository metadata in the chroot can be used without refreshing it.
+# Needs to be called after all repositories were added, as changed repositories invalidate the cached metadata.
+# If the metadata is not fresh, the caller is expected to refresh it and call mark_package_metadata_refreshed.
+def package_metadata_fresh() -> bool:
+    if not package_cache_mount or not metadata_max_age:
+        return False
+    if metadata_state and metadata_state["sources"] == _hash_sources(package_cache_distro) and \
+            time() - metadata_state["updated"] <= metadata_max_age:
+        print_status("Using cached repository metadata")
+        return True
+    return False
+
+
+# Stamp the repository metadata in the chroot as fresh. Needs to be called after the metadata was refreshed
+# successfully, as a failed refresh would otherwise leave outdated metadata in the cache that counts as fresh.
+def mark_package_metadata_refreshed() -> None:
+    if not package_cache_mount:
+        return
+    metadata_state.update({"updated": time(), "sources": _hash_sources(package_cache_distro)})
+
+
+# Copy cached repository metadata into the chroot and load its freshness stamp
+def _restore_metadata(distro_name: str) -> None:
+    metadata_state.clear()
+    host_dir = f"{package_cache_dir}/{package_cache_name}-metadata"
+    try:
+        with open(f"{host_dir}.json", "r") as stamp_file:
+            stamp = json.load(stamp_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    if distro_name in metadata_paths:
+        if not path_exists(host_dir):
+            return
+        print_status("Restoring cached repository metadata")
+        cpdir(host_dir, f"/mnt/depthboot{metadata_paths[distro_name]}")
+    metadata_state.update(stamp)
+
+
+# Save the repository metadata of the chroot into the cache
+def _save_metadata(distro_name: str) -> None:
+    if not metadata_state:  # metadata was never refreshed by this build or loaded from the cache
+        return
+    host_dir = f"{package_cache_dir}/{package_cache_name}-metadata"
+    if distro_name in metadata_paths:
+        print_status("Saving repository metadata to cache")
+        if path_exists(host_dir):
+            rmdir(host_dir, keep_dir=False)
+        cpdir(f"/mnt/depthboot{metadata_paths[distro_name]}", host_dir)
+    with open(f"{host_dir}.json", "w") as stamp_file:
+        json.dump(metadata_state, stamp_file)
+
+
+# hash the repository configs of the chroot
+def _hash_sources(distro_name: str) -> str:
+    sources_hash = hashlib.sha256()
+    for source in metadata_sources[distro_name]:
+        source_path = Path(f"/mnt/depthboot{source}")
+        files = sorted(source_path.rglob("*")) if source_path.is_dir() else [source_path]
+        for file in files:
+            if file.is_file():
+                sources_hash.update(file.name.encode())
+                sources_hash.update(file.read_bytes())
+    return sources_hash.hexdigest()
+
+
+# Most package managers delete downloaded packages after installing them. Configure them to keep the packages.
+def _keep_downloaded_packages(distro_name: str) -> None:
+    match distro_name:
+        case "ubuntu" | "pop-os":
+            # container based rootfs tarballs include an apt hook that deletes all packages after each transaction
+            docker_clean = "/mnt/depthboot/etc/apt/apt.conf.d/docker-clean"
+            if path_exists(docker_clean):
+                bash(f"mv {docker_clean} {docker_clean}.depthboot")
+                package_cache_configs.append((docker_clean, f"{docker_clean}.depthboot"))
+            keep_conf = "/mnt/depthboot/etc/apt/apt.conf.d/99depthboot-keep-packages"
+            with open(keep_conf, "w") as f:
+                f.write('Binary::apt::APT::Keep-Downloaded-Packages "true";\nAPT::Keep-Downloaded-Packages "true";\n')
+            package_cache_configs.append((keep_conf, None))
+        case "fedora":
+            with open("/mnt/depthboot/etc/dnf/dnf.conf", "a") as f:
+                f.write("\nkeepcache=True\n")
+            package_cache_configs.append(("/mnt/depthboot/etc/dnf/dnf.conf", "\nkeepcache=True\n"))
+        # pacman keeps all downloaded packages by default
+
+
+# atime is updated when the package manager installs a cached package (at most once a day with relatime)
+def _last_used(package: Path) -> float:
+    package_stat = package.stat()
+    return max(package_stat.st_atime, package_stat.st_mtime)
@@ -0,0 +1,214 @@
+# Progress output for the package managers inside the chroot, replacing the trackers of the vendored functions.py,
+# which is overwritten by the python-os-functions copy every night. Import them explicitly after
+# "from functions import *".
+# TO AVOID ISSUES: Sync all repos before calling package manager functions
+# The functions below, will start a thread to monitor the progress of their respective package managers.
+# The log is followed from the last read byte offset and only new lines are parsed, by a parser with the state of
+# the respective package manager. Each parsed line can emit a PackageProgress event.
+import os
+import re
+import subprocess
+from threading import Event, Thread
+from typing import NamedTuple
+
+import functions
+from functions import *
+from commands import chroot
+
+
+class PackageProgress(NamedTuple):
+    stage: str  # "download", "install", "configure", "hooks" or "done"
+    package: str  # package or hook name, empty for "done"
+    current: int
+    total: int  # 0 if unknown
+
+
+def track_apt(path_to_log: str, on_event=None) -> "PackageManagerTracker":
+    return PackageManagerTracker(path_to_log, _AptParser(), on_event).start()
+
+
+def track_dnf(path_to_log: str, on_event=None) -> "PackageManagerTracker":
+    return PackageManagerTracker(path_to_log, _DnfParser(), on_event).start()
+
+
+def track_pacman(path_to_log: str, on_event=None) -> "PackageManagerTracker":
+    return PackageManagerTracker(path_to_log, _PacmanParser(), on_event).start()
+
+
+# Run a package manager command inside the chroot with its output written to a log, which is tracked to print the
+# progress instead. package_manager is "apt", "dnf" or "pacman".
+def chroot_with_progress(command: str, package_manager: str) -> None:
+    if functions.verbose:  # the full output is more useful than the progress
+        chroot(command)
+        return
+    log = "/tmp/depthboot-package-manager.log"
+    rmfile(f"/mnt/depthboot{log}")
+    tracker = {"apt": track_apt, "dnf": track_dnf, "pacman": track_pacman}[package_manager](f"/mnt/depthboot{log}")
+    try:
+        chroot(f"{command} > {log}")  # errors are still printed to stderr
+    except subprocess.CalledProcessError as e:
+        tracker.stop()
+        print_error(f"\n{package_manager} failed, last lines of its output:")
+        with open(f"/mnt/depthboot{log}", "r", errors="replace") as file:
+            print("".join(file.readlines()[-20:]), flush=True)
+        raise e
+    finally:
+        tracker.stop()
+        rmfile(f"/mnt/depthboot{log}")
+
+
+# Default event handler: prints the current package on a single line, that is overwritten by the next event
+def print_package_progress(event: PackageProgress) -> None:
+    if event.stage == "done":
+        print("\nInstallation finished", flush=True)
+        return
+    if no_download_progress:  # \r does not work in non-interactive shells -> only print stage changes
+        if event.current == 1:
+            print(f"{event.stage.capitalize()} {event.total or 'unknown amount of'} packages", flush=True)
+        return
+    total = f"/{event.total}" if event.total else ""
+    print(f"\033[2K{event.stage.capitalize()} {event.package} ({event.current}{total})", end="\r", flush=True)
+
+
+# Follows a growing log file in a thread. Wakes up every poll_interval seconds, but only reads the file if its size
+# changed and only parses complete new lines.
+class PackageManagerTracker:
+    poll_interval = 0.5
+
+    def __init__(self, path_to_log: str, parser, on_event=None):
+        self.path_to_log = path_to_log
+        self.parser = parser
+        self.on_event = on_event or print_package_progress
+        self.offset = 0
+        self.partial_line = b""
+        self.stopped = Event()
+        self.thread = Thread(target=self._follow, daemon=True)
+
+    def start(self) -> "PackageManagerTracker":
+        self.thread.start()
+        return self
+
+    # stop following the log after reading its remaining lines
+    def stop(self) -> None:
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.thread.join()
+
+    def _follow(self) -> None:
+        while not self.stopped.wait(self.poll_interval):
+            self._read_new_lines()
+        self._read_new_lines()
+
+    def _read_new_lines(self) -> None:
+        try:
+            size = os.stat(self.path_to_log).st_size
+        except FileNotFoundError:  # package manager didn't start yet
+            return
+        if size < self.offset:  # log was replaced
+            self.offset, self.partial_line = 0, b""
+        if size == self.offset:
+            return
+        with open(self.path_to_log, "rb") as file:
+            file.seek(self.offset)
+            data = self.partial_line + file.read(size - self.offset)
+        self.offset = size
+        lines = data.split(b"\n")
+        self.partial_line = lines.pop()  # incomplete line, completed by the next read
+        for line in lines:
+            # progress bars are redrawn with \r -> only the last state of the line is relevant
+            event = self.parser.parse(line.decode(errors="replace").rsplit("\r", 1)[-1].rstrip())
+            if event is not None:
+                self.on_event(event)
+
+
+# pacman prints the amount of packages, then one line per downloaded package, one line per installed package and the
+# post-transaction hooks with their own counter
+class _PacmanParser:
+    def __init__(self):
+        self.stage = "resolve"
+        self.total = 0
+        self.downloaded = set()
+        self.installed = set()
+
+    def parse(self, line: str):
+        if self.stage == "resolve":
+            if match := re.match(r"Packages? \((\d+)\)", line):
+                self.total = int(match[1])
+            elif line.startswith(":: Retrieving packages"):
+                self.stage = "download"
+            elif line.startswith(":: Processing package changes"):  # all packages were cached
+                self.stage = "install"
+        elif self.stage == "download":
+            if line.startswith(":: Processing package changes"):
+                self.stage = "install"
+            elif match := re.match(r"\s*(\S+) downloading", line):
+                if match[1] not in self.downloaded:
+                    self.downloaded.add(match[1])
+                    return PackageProgress("download", match[1], len(self.downloaded), self.total)
+        elif self.stage == "install":
+            if line.startswith(":: Running post-transaction hooks"):
+                self.stage = "hooks"
+            # the (n/m) counter is only printed with a progress bar, i.e. not if the output is written to a log
+            elif match := re.match(r"(?:\(\s*\d+/\s*\d+\) )?(?:installing|upgrading|reinstalling|downgrading) "
+                                   r"(\S+?)(?:\.\.\.)?(?:\s|$)", line):
+                if match[1] not in self.installed:
+                    self.installed.add(match[1])
+                    return PackageProgress("install", match[1], len(self.installed), self.total)
+        elif self.stage == "hooks":
+            if match := re.match(r"\(\s*(\d+)/\s*(\d+)\) (.+?)\.*$", line):
+                if match[1] == match[2]:  # pacman has no final success message
+                    self.stage = "done"
+                    return PackageProgress("done", "", int(match[1]), int(match[2]))
+                return PackageProgress("hooks", match[3], int(match[1]), int(match[2]))
+
+
+# apt prints the amount of packages, one Get line per download, then Unpacking and Setting up lines per package and
+# finally the triggers
+class _AptParser:
+    def __init__(self):
+        self.total = 0
+        self.downloads = 0
+        self.unpacked = set()
+        self.configured = set()
+        self.triggers = set()
+
+    def parse(self, line: str):
+        if match := re.match(r"(\d+) upgraded, (\d+) newly installed", line):
+            self.total = int(match[1]) + int(match[2])
+        elif match := re.match(r"Get:\d+ \S+ \S+ \S+ (\S+)", line):
+            self.downloads += 1
+            return PackageProgress("download", match[1], self.downloads, self.total)
+        elif match := re.match(r"Unpacking (\S+)", line):
+            if match[1] not in self.unpacked:
+                self.unpacked.add(match[1])
+                return PackageProgress("install", match[1], len(self.unpacked), self.total)
+        elif match := re.match(r"Setting up (\S+)", line):
+            if match[1] not in self.configured:
+                self.configured.add(match[1])
+                return PackageProgress("configure", match[1], len(self.configured), self.total)
+        elif match := re.match(r"Processing triggers for (\S+)", line):
+            # triggers run multiple times in a transaction, but are counted once
+            self.triggers.add(match[1])
+            return PackageProgress("hooks", match[1], len(self.triggers), 0)
+
+
+# dnf prints the transaction summary, one line per downloaded package with its own counter, then one line per
+# package and step of the rpm transaction
+class _DnfParser:
+    def __init__(self):
+        self.total = 0
+        self.installed = set()
+
+    def parse(self, line: str):
+        if match := re.match(r"(?:Install|Upgrade|Reinstall|Downgrade)\s+(\d+) Packages?", line):
+            self.total += int(match[1])
+        elif match := re.match(r"\((\d+)/(\d+)\): (\S+)", line):
+            return PackageProgress("download", match[3], int(match[1]), int(match[2]))
+        elif match := re.match(r"\s+(?:Installing|Upgrading|Reinstalling|Downgrading)\s*: (\S+)\s+(\d+)/(\d+)$", line):
+            if match[1] not in self.installed:
+                self.installed.add(match[1])
+                return PackageProgress("install", match[1], len(self.installed), self.total)
+        elif match := re.match(r"\s+Running scriptlet\s*: (\S+)\s+(\d+)/(\d+)$", line):
+            return PackageProgress("hooks", match[1], int(match[2]), int(match[3]))
+        elif line.startswith("Complete!"):
+            return PackageProgress("done", "", len(self.installed), self.total)
@@ -0,0 +1,38 @@
+# Tests for the repository metadata cache of package_cache.py, with the chroot paths redirected into a temporary dir
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import package_cache  # noqa: E402
+from distro import ubuntu  # noqa: E402
+
+
+def test_ubuntu_metadata_stamp_with_mirror(tmp_path, monkeypatch):
+    (tmp_path / "etc/apt/sources.list.d").mkdir(parents=True)
+    (tmp_path / "etc/apt/sources.list").write_text("deb http://archive.ubuntu.com/ubuntu jammy main\n")
+    (tmp_path / "var/lib/apt/lists").mkdir(parents=True)
+
+    def in_chroot(path) -> str:
+        return str(path).replace("/mnt/depthboot", str(tmp_path), 1)
+
+    sources_in_chroot = []
+    monkeypatch.setattr(ubuntu, "open", lambda path, *args, **kwargs: open(in_chroot(path), *args, **kwargs),
+                        raising=False)
+    monkeypatch.setattr(ubuntu, "Path", lambda path: Path(in_chroot(path)))
+    monkeypatch.setattr(package_cache, "Path", lambda path: Path(in_chroot(path)))
+    monkeypatch.setattr(ubuntu, "find_mirror", lambda distro_version: "http://mirror.example.com/ubuntu/")
+    monkeypatch.setattr(ubuntu, "chroot",
+                        lambda command: sources_in_chroot.append((tmp_path / "etc/apt/sources.list").read_text()))
+    monkeypatch.setattr(package_cache, "package_cache_mount", "/var/cache/apt/archives")
+    monkeypatch.setattr(package_cache, "package_cache_distro", "ubuntu")
+    monkeypatch.setattr(package_cache, "metadata_max_age", 3600)
+    monkeypatch.setattr(package_cache, "metadata_state", {})
+
+    ubuntu.config_restored_base("22.04", False)
+
+    # apt ran against the mirror, the stamp still has to match the archive.ubuntu.com sources of the image
+    assert all("mirror.example.com" in sources for sources in sources_in_chroot)
+    assert "archive.ubuntu.com" in (tmp_path / "etc/apt/sources.list").read_text()
+    assert package_cache.package_metadata_fresh()
@@ -0,0 +1,124 @@
+# Tests for the package manager log parsers of progress.py, with logs as they are written when the output of the
+# package manager is redirected to a file
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from progress import PackageProgress, _AptParser, _DnfParser, _PacmanParser  # noqa: E402
+
+
+def parse_log(parser, log: str) -> list:
+    events = []
+    for line in log.split("\n"):
+        event = parser.parse(line)
+        if event is not None:
+            events.append(event)
+    return events
+
+
+def test_pacman_parser():
+    log = """resolving dependencies...
+looking for conflicting packages...
+
+Packages (2) nano-7.2-1  zram-generator-1.1.2-1
+
+Total Download Size:   0.93 MiB
+Total Installed Size:  3.26 MiB
+
+:: Proceed with installation? [Y/n]
+:: Retrieving packages...
+ nano-7.2-1-x86_64 downloading...
+ zram-generator-1.1.2-1-x86_64 downloading...
+checking keyring...
+checking package integrity...
+loading package files...
+checking for file conflicts...
+:: Processing package changes...
+installing nano...
+installing zram-generator...
+:: Running post-transaction hooks...
+(1/2) Reloading system manager configuration...
+(2/2) Arming ConditionNeedsUpdate..."""
+    assert parse_log(_PacmanParser(), log) == [
+        PackageProgress("download", "nano-7.2-1-x86_64", 1, 2),
+        PackageProgress("download", "zram-generator-1.1.2-1-x86_64", 2, 2),
+        PackageProgress("install", "nano", 1, 2),
+        PackageProgress("install", "zram-generator", 2, 2),
+        PackageProgress("hooks", "Reloading system manager configuration", 1, 2),
+        PackageProgress("done", "", 2, 2)
+    ]
+
+
+def test_pacman_parser_progress_bar():
+    # lines of a terminal with progress bars, after the \r redraws were removed by the tracker
+    log = """Packages (1) nano-7.2-1
+:: Processing package changes...
+(1/1) installing nano                               [######################] 100%
+:: Running post-transaction hooks...
+(1/1) Arming ConditionNeedsUpdate..."""
+    assert parse_log(_PacmanParser(), log) == [
+        PackageProgress("install", "nano", 1, 1),
+        PackageProgress("done", "", 1, 1)
+    ]
+
+
+def test_apt_parser():
+    log = """Reading package lists...
+Building dependency tree...
+The following NEW packages will be installed:
+  keyd nano
+0 upgraded, 2 newly installed, 0 to remove and 0 not upgraded.
+Get:1 http://archive.ubuntu.com/ubuntu jammy/main amd64 nano amd64 6.2-1 [280 kB]
+Get:2 https://eupnea-linux.github.io/apt-repo/debian_ubuntu jammy/main amd64 keyd amd64 2.4.2 [40 kB]
+Fetched 320 kB in 1s (320 kB/s)
+Selecting previously unselected package nano.
+Preparing to unpack .../nano_6.2-1_amd64.deb ...
+Unpacking nano (6.2-1) ...
+Preparing to unpack .../keyd_2.4.2_amd64.deb ...
+Unpacking keyd (2.4.2) ...
+Setting up nano (6.2-1) ...
+Setting up keyd (2.4.2) ...
+Processing triggers for man-db (2.10.2-1) ...
+Processing triggers for man-db (2.10.2-1) ..."""
+    assert parse_log(_AptParser(), log) == [
+        PackageProgress("download", "nano", 1, 2),
+        PackageProgress("download", "keyd", 2, 2),
+        PackageProgress("install", "nano", 1, 2),
+        PackageProgress("install", "keyd", 2, 2),
+        PackageProgress("configure", "nano", 1, 2),
+        PackageProgress("configure", "keyd", 2, 2),
+        PackageProgress("hooks", "man-db", 1, 0),
+        PackageProgress("hooks", "man-db", 1, 0)
+    ]
+
+
+def test_dnf_parser():
+    log = """Dependencies resolved.
+Transaction Summary
+================================================================================
+Install  2 Packages
+
+Total download size: 1.0 M
+Downloading Packages:
+(1/2): keyd-2.4.2-1.fc37.x86_64.rpm              100 kB/s |  40 kB     00:00
+(2/2): nano-6.0-2.fc37.x86_64.rpm                1.0 MB/s | 700 kB     00:00
+Running transaction
+  Preparing        :                                                        1/1
+  Installing       : nano-6.0-2.fc37.x86_64                                 1/2
+  Installing       : keyd-2.4.2-1.fc37.x86_64                               2/2
+  Running scriptlet: keyd-2.4.2-1.fc37.x86_64                               2/2
+  Verifying        : keyd-2.4.2-1.fc37.x86_64                               1/2
+
+Installed:
+  keyd-2.4.2-1.fc37.x86_64              nano-6.0-2.fc37.x86_64
+
+Complete!"""
+    assert parse_log(_DnfParser(), log) == [
+        PackageProgress("download", "keyd-2.4.2-1.fc37.x86_64.rpm", 1, 2),
+        PackageProgress("download", "nano-6.0-2.fc37.x86_64.rpm", 2, 2),
+        PackageProgress("install", "nano-6.0-2.fc37.x86_64", 1, 2),
+        PackageProgress("install", "keyd-2.4.2-1.fc37.x86_64", 2, 2),
+        PackageProgress("hooks", "keyd-2.4.2-1.fc37.x86_64", 2, 2),
+        PackageProgress("done", "", 2, 2)
+    ]
@@ -0,0 +1,45 @@
+# Collects package installs and removals of multiple build stages, to apply them in a single package manager run.
+# Each run resolves all dependencies again and reruns hooks like initramfs, man-db and icon caches.
+# The distro modules create their transactions with the commands of their package manager.
+import contextlib
+import shlex
+from typing import Callable
+
+from functions import *
+from progress import chroot_with_progress
+
+
+class Transaction:
+    def __init__(self, install_command: str, package_manager: str, remove_suffix: str = "",
+                 environment: Callable = contextlib.nullcontext):
+        """
+        :param install_command: A string representing the install command, the packages are appended to it.
+        :param package_manager: A string representing the name of the package manager, used to track the progress.
+        :param remove_suffix: The suffix that makes the install command remove a package. Empty if it can't.
+        :param environment: A function returning a context manager that the commands are run in.
+        """
+        self.install_command = install_command
+        self.package_manager = package_manager
+        self.remove_suffix = remove_suffix
+        self.environment = environment
+        self.packages = []
+
+    def install(self, packages: str) -> None:
+        self.packages.extend(packages.split())
+
+    def install_group(self, group: str) -> None:
+        self.packages.append(f"@{group}")  # dnf installs groups prefixed with @
+
+    def remove(self, packages: str) -> None:
+        if not self.remove_suffix:
+            raise ValueError(f"{self.package_manager} transactions can't remove packages")
+        self.packages.extend(f"{package}{self.remove_suffix}" for package in packages.split())
+
+    def apply(self) -> None:
+        if not self.packages:
+            return
+        # group names contain spaces -> quote everything
+        packages = " ".join(shlex.quote(package) for package in self.packages)
+        with self.environment():
+            chroot_with_progress(f"{self.install_command} {packages}", self.package_manager)
+        self.packages.clear()